@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the dashboard rendering.
+Draws a dashboard with the panes of uro_fMRI for a number of frames, with
+every stimulus drawn every frame and with the cached static layer, and
+reports the draw calls, the CPU time and (with OpenGL timer queries) the GPU
+time per frame. The countdown text changes every 60 frames as in a session.
+Run from the repository root: python benchmarks/bench_dashboard.py
+Needs PsychoPy and a display.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from psychopy import visual  # noqa: E402
+
+import uro_render  # noqa: E402
+
+n_frames = 600
+
+win = visual.Window([1280, 1024], monitor="testMonitor", units="norm", colorSpace='rgb255', color=(21, 35, 46))
+
+
+def pane(x, y, w, h, title, text):
+    # box, header bar, header text and body text of a pane
+    box = visual.Rect(win=win, size=(w, h), pos=(x, y), colorSpace='rgb255', lineColor=(48, 63, 81),
+                      fillColor=(48, 63, 81))
+    hdr = visual.Rect(win=win, size=(w, 0.2), pos=(x, y + h / 2 + 0.1), colorSpace='rgb255',
+                      lineColor=(75, 100, 129), fillColor=(75, 100, 129))
+    txt_hdr = visual.TextStim(win=win, pos=(x, y + h / 2 + 0.1), height=0.15, alignText='left', text=title,
+                              wrapWidth=w - 0.1)
+    txt_box = visual.TextStim(win=win, pos=(x, y), height=0.12, alignText='left', text=text, wrapWidth=w - 0.1)
+    return [box, hdr, txt_hdr], txt_box
+
+
+title = [visual.Rect(win=win, size=(2, 0.36), pos=(0, 0.82), colorSpace='rgb255', fillColor=(31, 42, 53)),
+         visual.TextStim(win=win, pos=(0, 0.82), height=0.15, text="URO-MRI\nfMRI Tool"),
+         visual.TextStim(win=win, pos=(0, -0.95), height=0.05, text="(C) 2021 Pieter Vandemaele")]
+cmd_static, txt_cmd = pane(0, 0.25, 1.8, 0.44, 'Command', 'Event 1\nInfuse')
+flow_static, txt_flow = pane(-0.45, -0.55, 0.9, 0.6, 'Flow info', 'Volume: 8.3 ml\nRate: 100 ml/s')
+cntr_static, txt_cntr = pane(0.5, -0.55, 0.7, 0.6, 'Timer', '10')
+
+for cache in (False, True):
+    dashboard = uro_render.layered_dashboard(win, title + cmd_static + flow_static + cntr_static,
+                                             [txt_flow, txt_cmd, txt_cntr], cache=cache, gpu_timing=True)
+    for i in range(n_frames):
+        if i % 60 == 0:
+            txt_cntr.text = str(n_frames // 60 - i // 60)
+        dashboard.draw()
+        win.flip()
+    print(dashboard.report())
+
+win.close()
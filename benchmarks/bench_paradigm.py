@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the paradigm compiler.
+Compiles paradigms of increasing length, built by repeating the event
+block used in uro_fMRI.py, and reports the best compile time.
+Run from the repository root: python benchmarks/bench_paradigm.py
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import uro_paradigm  # noqa: E402
+
+# T-LSR150B at a microstep resolution of 64
+microstep_size = 25.4 / (200 * 64 * 4) * 1000
+max_velocity = 20 * 1000 / microstep_size / 9.375
+sizes = [10, 100, 1000, 10000, 100000]
+repeats = 5
+
+
+def make_paradigm(n):
+    block = [['event', 'pause', 2, 'Event\nPause 1'],
+             ['event', 'infuse', 5, 'Event\nInfuse', 500],
+             ['event', 'pause', 2, 'Event\nPause 2'],
+             ['event', 'withdraw', 5, 'Event\nWithdraw', 500]]
+    return [list(block[i % len(block)]) for i in range(n)]
+
+
+print('{:>10} {:>12} {:>14}'.format('entries', 'compile ms', 'µs per entry'))
+for n in sizes:
+    paradigm = make_paradigm(n)
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        uro_paradigm.compile_paradigm(paradigm, microstep_size, max_velocity)
+        best = min(best, time.perf_counter() - t0)
+    print('{:>10} {:>12.3f} {:>14.3f}'.format(n, best * 1000, best / n * 1e6))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Latency distributions of the Zaber commands used by the URO tools.
+Runs zaber_tools against a simulated device at several baud rates and
+reports the median, 95th and 99th percentile and maximum latency per command:
+- the round-trip of RETURN_SETTING 37, RETURN_SETTING 50 (device id),
+  RETURN_CURRENT_POSITION and SET_TARGET_SPEED
+- the move overhead: the measured duration of a short relative move minus
+  the duration of its velocity profile
+- the time between sending STOP during a move and its reply
+Run from the repository root: python benchmarks/bench_zaber_latency.py
+Linux and macOS only (the simulator uses a pseudo-terminal).
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zaber_motion.binary import CommandCode  # noqa: E402
+
+import zaber_sim  # noqa: E402
+import zaber_tools  # noqa: E402
+
+baud_rates = [9600, 115200]
+link_delay = 0.001  # s, one way
+n_commands = 200
+n_moves = 20
+move_distance = 200  # microsteps
+speed = 1000  # target speed, data units
+
+
+def connect(sim):
+    # the connection banner is not part of the benchmark
+    with contextlib.redirect_stdout(io.StringIO()):
+        return zaber_tools.zaber_tools(sim.port, snapshot_dir=None)
+
+
+def round_trips(zt, command, data):
+    latencies = []
+    for _ in range(n_commands):
+        t0 = time.perf_counter()
+        zt.command(1, command, data)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def set_speed(zt):
+    # alternate the value, set_setting skips writes that change nothing
+    latencies = []
+    for i in range(n_commands):
+        t0 = time.perf_counter()
+        zt.set_setting(1, CommandCode.SET_TARGET_SPEED, speed + i % 2).result(5)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def move_overhead(zt, sim):
+    device = sim.device(1)
+    profile = zaber_sim.axis_model()
+    expected = profile.move_to(move_distance, 0.0, device.speed(), device.acceleration())
+    latencies = []
+    for i in range(n_moves):
+        move = zt.move_relative(move_distance if i % 2 == 0 else -move_distance)
+        zt.wait_move(move, timeout=5)
+        latencies.append(move.duration() - expected)
+    return latencies
+
+
+def stop_latency(zt):
+    latencies = []
+    for _ in range(n_moves):
+        zt.move_relative(20000)
+        time.sleep(0.02)
+        t0 = time.perf_counter()
+        zt.stop(1).wait(5)
+        latencies.append(time.perf_counter() - t0)
+        zt.move_absolute(0).wait(30)
+    return latencies
+
+
+print('{:>8} {:<24} {:>8} {:>8} {:>8} {:>8}'.format('baud', 'command', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+for baud in baud_rates:
+    with zaber_sim.zaber_sim(baud=baud, link_delay=link_delay) as sim:
+        zt = connect(sim)
+        try:
+            zt.set_setting(1, CommandCode.SET_TARGET_SPEED, speed).result(5)
+            results = [('RETURN_SETTING 37', round_trips(zt, CommandCode.RETURN_SETTING, 37)),
+                       ('RETURN_SETTING 50', round_trips(zt, CommandCode.RETURN_SETTING, 50)),
+                       ('RETURN_CURRENT_POSITION', round_trips(zt, CommandCode.RETURN_CURRENT_POSITION, 0)),
+                       ('SET_TARGET_SPEED', set_speed(zt)),
+                       ('move overhead', move_overhead(zt, sim)),
+                       ('STOP', stop_latency(zt))]
+        finally:
+            zt.close()
+    for name, latencies in results:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print('{:>8} {:<24} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            baud, name, p50, p95, p99, max(latencies) * 1000))
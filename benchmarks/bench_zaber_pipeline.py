@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the Zaber transport modes against a simulated device.
+Sends batches of RETURN_SETTING commands through zaber_tools, lock-step
+(one command per round-trip) and pipelined with message IDs, and reports the
+commands per second for several adapter link delays (the baud rate is not
+modelled here, see bench_zaber_latency.py).
+Run from the repository root: python benchmarks/bench_zaber_pipeline.py
+Linux and macOS only (the simulator uses a pseudo-terminal).
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zaber_motion.binary import CommandCode  # noqa: E402
+
+import zaber_sim  # noqa: E402
+import zaber_tools  # noqa: E402
+
+link_delays = [0.0005, 0.001, 0.004]  # s, one way; USB-serial adapters add 1-16 ms
+batch_sizes = [1, 4, 16]
+n_commands = 64
+repeats = 3
+
+
+def connect(sim, message_ids):
+    # the connection banner is not part of the benchmark
+    with contextlib.redirect_stdout(io.StringIO()):
+        return zaber_tools.zaber_tools(sim.port, snapshot_dir=None, message_ids=message_ids)
+
+
+def run(zt, batch):
+    commands = [(1, CommandCode.RETURN_SETTING, 37)] * batch
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(n_commands // batch):
+            zt.pipeline(commands).result(10)
+        best = min(best, time.perf_counter() - t0)
+    return n_commands / best
+
+
+print('{:>10} {:>6} {:>14} {:>14} {:>8}'.format('link ms', 'batch', 'lock-step/s', 'pipelined/s', 'speedup'))
+for link_delay in link_delays:
+    rates = {}
+    for message_ids in (False, True):
+        with zaber_sim.zaber_sim(baud=None, link_delay=link_delay) as sim:
+            zt = connect(sim, message_ids)
+            try:
+                rates[message_ids] = [run(zt, batch) for batch in batch_sizes]
+            finally:
+                zt.close()
+    for i, batch in enumerate(batch_sizes):
+        print('{:>10.1f} {:>6} {:>14.0f} {:>14.0f} {:>8.1f}'.format(
+            link_delay * 1000, batch, rates[False][i], rates[True][i], rates[True][i] / rates[False][i]))
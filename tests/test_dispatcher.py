@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+import uro_dryrun
+import zaber_tools
+
+dispatcher = zaber_tools.zaber_dispatcher
+
+
+def future():
+    return zaber_tools.zaber_command(1, 0, 0, time.perf_counter)
+
+
+def returns(fn, timeout=2.0):
+    # Whether fn() returns within timeout, the call is left behind otherwise
+    thread = threading.Thread(target=fn, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def blocked(d):
+    # Occupy the dispatcher thread until the returned gate is set
+    gate, running = threading.Event(), threading.Event()
+    d.submit(lambda f: running.set() or gate.wait(5.0), future())
+    assert running.wait(2.0)
+    return gate
+
+
+def test_wait_idle_waits_for_the_queued_jobs():
+    d = dispatcher(time.perf_counter)
+    gate = blocked(d)
+    job = d.submit(lambda f: 'done', future())
+    assert not d.wait_idle(0.05)
+    gate.set()
+    assert d.wait_idle(2.0)
+    assert job.done() and job.result() == 'done'
+    d.close()
+
+
+def test_jobs_run_by_priority():
+    d = dispatcher(time.perf_counter)
+    gate = blocked(d)
+    order = []
+    for name, priority in [('normal', d.PRIORITY_NORMAL), ('background', d.PRIORITY_BACKGROUND),
+                           ('urgent', d.PRIORITY_URGENT)]:
+        d.submit(lambda f, name=name: order.append(name), future(), priority)
+    gate.set()
+    assert d.wait_idle(2.0)
+    assert order == ['urgent', 'normal', 'background']
+    d.close()
+
+
+def test_errors_complete_the_future():
+    d = dispatcher(time.perf_counter)
+    job = d.submit(lambda f: 1 / 0, future())
+    with pytest.raises(ZeroDivisionError):
+        job.result(2.0)
+    assert job.send_time is not None and job.reply_time is not None
+    d.close()
+
+
+def test_close_finishes_the_queue_and_wait_idle_returns():
+    d = dispatcher(time.perf_counter)
+    gate = blocked(d)
+    jobs = [d.submit(lambda f, i=i: i, future()) for i in range(5)]
+    threading.Timer(0.05, gate.set).start()
+    d.close()
+    assert [job.result(0) for job in jobs] == list(range(5))
+    # the sentinel is done as well, nothing is left to wait for
+    assert d._queue.unfinished_tasks == 0
+    assert returns(d.wait_idle)
+    with pytest.raises(RuntimeError):
+        d.submit(lambda f: None, future())
+
+
+def test_close_from_a_job():
+    d = dispatcher(time.perf_counter)
+    job = d.submit(lambda f: d.close(), future())
+    assert job.wait(2.0)
+    assert returns(d.wait_idle)
+    d._thread.join(2.0)
+    assert not d._thread.is_alive()
+
+
+def test_dry_run_clock_runs_on_after_close():
+    # the dispatcher is a barrier of the virtual clock in a dry run
+    clock = uro_dryrun.virtual_clock()
+    zt = zaber_tools.zaber_tools('dry run', clock=clock.getTime, connection=uro_dryrun.pump_connection(clock))
+    clock.add_barrier(zt.dispatcher.wait_idle)
+    move = zt.move_relative(1000)
+    clock.advance_to(clock.getTime() + 1.0)
+    assert move.wait(2.0)
+    zt.close()
+    assert returns(clock.frame)
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+logging = pytest.importorskip('psychopy.logging')
+import uro_logging  # noqa: E402
+
+
+class gated_handle:
+    # File handle whose writes wait until the gate opens
+    def __init__(self, handle):
+        self.handle = handle
+        self.gate = threading.Event()
+        self.writing = threading.Event()
+
+    def write(self, txt):
+        self.writing.set()
+        self.gate.wait(5.0)
+        return self.handle.write(txt)
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+def counter():
+    t = [0.0]
+
+    def clock():
+        t[0] += 1.0
+        return t[0]
+    return clock
+
+
+def lines(path):
+    with open(str(path), encoding='utf8') as f:
+        return f.read().splitlines()
+
+
+def test_flush_writes_every_record_by_level(tmp_path):
+    sink = uro_logging.log_sink(counter(), batch_size=3, max_latency=0.01)
+    data = sink.add_file(str(tmp_path / 'data.log'), logging.DATA)
+    info = sink.add_file(str(tmp_path / 'info.log'), logging.INFO)
+    for i in range(10):
+        sink.log('record {}'.format(i), logging.DATA if i % 2 else logging.INFO)
+    assert sink.flush(5.0)
+
+    # DATA ranks above INFO
+    assert [x.split('\t')[-1] for x in lines(info.path)] == ['record {}'.format(i) for i in range(10)]
+    assert [x.split('\t')[-1] for x in lines(data.path)] == ['record {}'.format(i) for i in range(1, 10, 2)]
+    assert float(lines(info.path)[0].split()[0]) == 1.0  # timestamped when queued
+    assert sink.batches >= 4
+    sink.close()
+
+
+def test_full_queue_waits_and_drops_nothing(tmp_path):
+    sink = uro_logging.log_sink(counter(), maxsize=4, batch_size=2, max_latency=0.0)
+    target = sink.add_file(str(tmp_path / 'data.log'), logging.DATA)
+    target.handle = gated_handle(target.handle)
+
+    # the writer holds the first record until the gate opens
+    sink.log('record 0', logging.DATA)
+    assert target.handle.writing.wait(5.0)
+    producer = threading.Thread(target=lambda: [sink.log('record {}'.format(i), logging.DATA) for i in range(1, 20)])
+    producer.start()
+    t_end = time.perf_counter() + 5.0
+    while sink.stalls == 0 and time.perf_counter() < t_end:
+        time.sleep(0.001)
+    assert sink.stalls > 0
+    assert producer.is_alive()  # blocked on the full queue
+
+    target.handle.gate.set()
+    producer.join(5.0)
+    sink.close()
+    assert [x.split('\t')[-1] for x in lines(target.path)] == ['record {}'.format(i) for i in range(20)]
+
+
+def test_close_writes_pending_records(tmp_path):
+    sink = uro_logging.log_sink(counter(), max_latency=10.0)
+    target = sink.add_file(str(tmp_path / 'data.log'), logging.DATA)
+    sink.log('last', logging.DATA)
+    sink.close()
+    sink.log('after close', logging.DATA)
+    assert [x.split('\t')[-1] for x in lines(target.path)] == ['last']
+
+
+def test_unknown_fsync_policy():
+    with pytest.raises(ValueError):
+        uro_logging.log_sink(counter(), fsync='sometimes')
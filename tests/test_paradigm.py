@@ -0,0 +1,89 @@
+import os
+from math import ceil
+
+import numpy as np
+import pytest
+
+import uro_paradigm
+import zaber_tools
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'paradigms', 'example.csv')
+MICROSTEP_SIZE = 0.49609375  # µm, T-LSR150B at 64 microsteps
+VELOCITY = uro_paradigm.VELOCITY_DATA_UNIT * MICROSTEP_SIZE * 0.001  # mm/s per unit of target speed data
+
+
+def baseline(paradigm, microstep_size):
+    # The per entry conversion process_paradigm did before the compiler,
+    # through the zaber_tools converters of a connection with this resolution
+    zt = zaber_tools.zaber_tools.__new__(zaber_tools.zaber_tools)
+    zt.zb_microstep_size = microstep_size
+    out = []
+    for event, command, duration, info, rate in paradigm:
+        distance_mustep = zt.dist_mm_to_mustep(duration * rate / 60)
+        velocity_mustep = int(ceil(zt.vel_mm_per_s_to_vel(rate / 60)))
+        distance_mm = duration * rate / 60
+        if command == 'withdraw':
+            distance_mustep, distance_mm = -abs(distance_mustep), -abs(distance_mm)
+        else:
+            distance_mustep, distance_mm = abs(distance_mustep), abs(distance_mm)
+        out.append((distance_mm, distance_mustep, velocity_mustep))
+    return np.array(out)
+
+
+def test_compile_rounds_like_the_baseline():
+    rng = np.random.default_rng(4)
+    size = MICROSTEP_SIZE
+    paradigm = [['event', 'infuse' if i % 2 else 'withdraw', float(d), 'info', float(r)]
+                for i, (d, r) in enumerate(zip(rng.uniform(0.1, 30, 2000).round(3),
+                                               rng.uniform(1, 1000, 2000).round(2)))]
+    # distances halfway between two microsteps, speeds on a data unit
+    paradigm += [['event', 'withdraw', 0.1, 'half', (k + 0.5) * size * 0.6] for k in range(1, 40)]
+    paradigm += [['event', 'infuse', 1., 'speed', k * VELOCITY * 60] for k in range(1, 40)]
+
+    compiled = uro_paradigm.compile_paradigm(paradigm, size)
+    expected = baseline(paradigm, size)
+    assert np.array_equal(compiled['mm'], expected[:, 0])
+    assert np.array_equal(compiled['microsteps'], expected[:, 1].astype('i8'))
+    assert np.array_equal(compiled['velocity'], expected[:, 2].astype('i8'))
+
+
+def test_cache_hit_needs_the_same_device_inputs(tmp_path):
+    load = uro_paradigm.load_paradigm
+    compiled, hit = load(EXAMPLE, MICROSTEP_SIZE, 64, 2000, cache_dir=str(tmp_path))
+    assert not hit
+    again, hit = load(EXAMPLE, MICROSTEP_SIZE, 64, 2000, cache_dir=str(tmp_path))
+    assert hit
+    assert np.array_equal(compiled, again)
+
+    # other mechanics give another microstep size, another limit another validation
+    assert not load(EXAMPLE, MICROSTEP_SIZE * 2, 64, 2000, cache_dir=str(tmp_path))[1]
+    assert not load(EXAMPLE, MICROSTEP_SIZE, 64, 3000, cache_dir=str(tmp_path))[1]
+    assert not load(EXAMPLE, MICROSTEP_SIZE, 64, {1: 2000}, cache_dir=str(tmp_path))[1]
+    assert not load(EXAMPLE, cache_dir=str(tmp_path))[1]
+    assert load(EXAMPLE, cache_dir=str(tmp_path))[1]
+
+
+def read(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return list(uro_paradigm.read_paradigm(str(path)))
+
+
+def test_csv_errors_name_the_row(tmp_path):
+    with pytest.raises(ValueError, match=r'bad\.csv, row 2: invalid paradigm row'):
+        read(tmp_path, 'bad.csv', 'rest, rest, 10, Rest\ninfuse, infuse, soon, Infuse, 120\n')
+
+
+def test_jsonl_errors_name_the_row(tmp_path):
+    good = '{"event": "rest", "command": "rest", "duration": 10, "info": "Rest"}\n'
+    assert read(tmp_path, 'good.jsonl', good) == [['rest', 'rest', 10.0, 'Rest']]
+    with pytest.raises(ValueError, match=r'row 2: missing duration'):
+        read(tmp_path, 'missing.jsonl', good + '{"event": "x", "command": "rest", "info": ""}\n')
+    with pytest.raises(ValueError, match=r'row 2: expected an object'):
+        read(tmp_path, 'array.jsonl', good + '["x", "rest", 10, ""]\n')
+    with pytest.raises(ValueError, match=r'row 2: expected an object'):
+        read(tmp_path, 'scalar.jsonl', good + '10\n')
+    with pytest.raises(ValueError, match=r'row 2: invalid JSON'):
+        read(tmp_path, 'broken.jsonl', good + '{"event": \n')
+    with pytest.raises(ValueError, match=r'row 2: invalid paradigm row'):
+        read(tmp_path, 'null.jsonl', good + '{"event": "x", "command": "rest", "duration": null, "info": ""}\n')
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import uro_paradigm
+
+PARADIGM = [['rest', 'rest', 10, 'Rest'],
+            ['infuse', 'infuse', 5, 'Infuse', 120],
+            ['pause', 'pause', 10, 'Pause'],
+            ['withdraw', 'withdraw', 5, 'Withdraw', 120]]
+
+
+def run(policy, finish_times, t0=100.0, tolerance=0.1):
+    # Present every entry until the time in finish_times (relative to t0, None: the scheduled end)
+    scheduler = uro_paradigm.paradigm_scheduler(uro_paradigm.compile_paradigm(PARADIGM), t0, policy, tolerance)
+    now = t0
+    slots = []
+    for idx, finish in enumerate(finish_times):
+        slot = scheduler.slot(idx, now)
+        slots.append(slot)
+        if slot is None:
+            break
+        now = slot[1] if finish is None else t0 + finish
+        scheduler.finished(idx, now)
+    return scheduler, slots
+
+
+def test_on_time_entries_follow_the_grid():
+    for policy in uro_paradigm.paradigm_scheduler.POLICIES:
+        scheduler, slots = run(policy, [None] * 4)
+        assert [s[0] - 100 for s in slots] == [0, 10, 15, 25]
+        assert [s[1] - 100 for s in slots] == [10, 15, 25, 30]
+        assert np.allclose(scheduler.lateness(), 0)
+
+
+def test_shorten_and_catchup_differ_on_a_partial_overrun():
+    # the rest entry overruns by 2 s, the infuse starts 2 s late
+    shorten, slots = run('shorten', [12, None, None, None])
+    assert slots[1][1] - 100 == pytest.approx(15)  # infuse shortened to 3 s
+    assert slots[2][0] - 100 == pytest.approx(15)  # later onsets fixed
+    assert shorten.shift == 0
+
+    catchup, slots = run('catchup', [12, None, None, None])
+    assert slots[1][1] - 100 == pytest.approx(17)  # infuse keeps its 5 s
+    assert slots[2][1] - 100 == pytest.approx(25)  # the pause catches up
+    assert slots[3][0] - 100 == pytest.approx(25)
+    assert catchup.shift == pytest.approx(2)
+
+
+def test_shorten_fully_overrun_entry_keeps_later_onsets():
+    scheduler, slots = run('shorten', [17, None, None, None])
+    assert slots[1][1] - 100 == pytest.approx(17)  # presented for zero time
+    assert slots[2] == (pytest.approx(115), pytest.approx(125))
+    assert scheduler.lateness()[2] == pytest.approx(2)
+
+
+def test_abort_beyond_tolerance():
+    scheduler, slots = run('abort', [10.05, 15.5, None, None])
+    assert slots[1] is not None  # within tolerance
+    assert slots[2] is None
+    assert scheduler.lateness()[2] == pytest.approx(0.5)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        uro_paradigm.paradigm_scheduler(uro_paradigm.compile_paradigm(PARADIGM), 0.0, 'skip')
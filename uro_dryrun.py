@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Dry runs of a URO session on an accelerated clock.
+A dry run replaces the experiment clock by a virtual_clock, the Zaber device
+by an in-process pump model and, optionally, the window by a headless one:
+- virtual_clock: drop-in for psychopy.core.Clock that runs at least at real
+  time and jumps ahead by a frame interval on every flip, so a session runs
+  as fast as its frames can be produced
+- pump_connection: stand-in for the ZML binary Connection used by
+  zaber_tools, the axes follow the trapezoidal motion of zaber_sim with its
+  speed, acceleration and position limits
+- virtual_recorder: position_recorder sampled on the virtual clock
+- headless_visual: Window, Rect, TextStim and BufferImageStim that do not draw
+The logs are written as in a real session; report() summarises the timing
+and the travel of the axes.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import heapq
+import threading
+import time
+import types
+
+import zaber_daemon
+import zaber_sim
+import zaber_tools
+
+
+class virtual_clock:
+    """Accelerated experiment clock.
+
+    The clock follows real time, so code that waits in real time still sees
+    time pass, and frame() (called on every flip) moves it on to at least
+    frame_interval after the previous frame. Barriers run before and
+    listeners after every frame, with the new time.
+    """
+
+    def __init__(self, frame_interval=1. / 60):
+        self.frame_interval = frame_interval
+        self.frames = 0
+        self.skipped = 0.0  # virtual time added on top of the real time
+        self._t0 = time.perf_counter()
+        self._t_reset = 0.0
+        self._last_frame = 0.0
+        self._barriers = []
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def getTime(self, applyZero=True):
+        # same signature as psychopy.core.Clock
+        return self._now() - self._t_reset
+
+    def reset(self, newT=0.0):
+        # as psychopy.core.Clock, the clock reads -newT afterwards
+        self._t_reset = self._now() + newT
+
+    def add(self, t):
+        self._t_reset += t
+
+    def real_time(self):
+        # Seconds of real time since the clock was created
+        return time.perf_counter() - self._t0
+
+    def add_barrier(self, fn):
+        # fn() blocks until the work queued at the current time is done
+        self._barriers.append(fn)
+
+    def remove_barrier(self, fn):
+        if fn in self._barriers:
+            self._barriers.remove(fn)
+
+    def add_listener(self, fn):
+        # fn(t) is called after every frame
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def frame(self):
+        self._step(None)
+
+    def advance_to(self, t):
+        # Move on to clock time t, as a frame without a flip
+        self._step(t + self._t_reset)
+
+    def _step(self, target):
+        for barrier in list(self._barriers):
+            barrier()
+        with self._lock:
+            now = self._now()
+            if target is None:
+                target = self._last_frame + self.frame_interval
+                self.frames += 1
+            if now < target:
+                self.skipped += target - now
+                now = target
+            self._last_frame = now
+        t = now - self._t_reset
+        for fn in list(self._listeners):
+            fn(t)
+
+    def _now(self):
+        return time.perf_counter() - self._t0 + self.skipped
+
+
+def attach_window(win, clock):
+    # Every flip of win (update calls flip) advances the virtual clock by a frame,
+    # flips of a headless window return the time of the new frame; functions
+    # passed to callOnFlip run after the clock moved on, so they see the time
+    # of the new frame
+    flip = win.flip
+    calls = []
+
+    def call_on_flip(function, *args, **kwargs):
+        calls.append((function, args, kwargs))
+
+    def frame_flip(*args, **kwargs):
+        result = flip(*args, **kwargs)
+        clock.frame()
+        t_flip = clock.getTime() if result is None else result
+        due = list(calls)
+        del calls[:len(due)]
+        for function, args_, kwargs_ in due:
+            function(*args_, **kwargs_)
+        return t_flip
+
+    win.flip = frame_flip
+    win.callOnFlip = call_on_flip
+    return win
+
+
+# ######################################################################
+# PUMP MODEL
+# ######################################################################
+class pump_device:
+    """Device returned by pump_connection.detect_devices."""
+
+    def __init__(self, connection, address, device_id):
+        self.connection = connection
+        self.device_address = address
+        self.identity = types.SimpleNamespace(device_id=device_id)
+
+    def identify(self):
+        return self.identity
+
+
+class pump_connection:
+    """In-process pump model with the ZML binary Connection calls of zaber_tools.
+
+    Commands execute at the time of the clock. The reply to a move is sent as
+    an event once a frame of the clock passes the end of the move; a move
+    sent with generic_command returns its final position at once.
+    start_position: microsteps, the middle of the travel range by default.
+    """
+
+    def __init__(self, clock, axes=1, start_position=None, max_speed=zaber_sim.MAX_SPEED_DATA, **device):
+        self.clock = clock
+        self.max_speed = max_speed
+        serial = device.pop('serial', 12345)
+        self.devices = [zaber_sim.sim_device(n, serial=serial + n - 1, **device) for n in range(1, axes + 1)]
+        for sim in self.devices:
+            axis = sim.axis
+            axis.set_position((axis.min_position + axis.max_position) // 2 if start_position is None
+                              else start_position)
+        self.start_positions = {sim.device_number: sim.axis.position_at(0) for sim in self.devices}
+        self.errors = 0  # error replies
+        self.reply_only = zaber_daemon._event_stream()
+        self.unknown_response = zaber_daemon._event_stream()
+        self._replies = []  # heap of (time, seq, device, move id, reply)
+        self._seq = 0
+        self._lock = threading.Lock()
+        clock.add_listener(self._advance)
+
+    def detect_devices(self, identify_devices=True):
+        return [self.get_device(sim.device_number) for sim in self.devices]
+
+    def get_device(self, address):
+        return pump_device(self, address, self.devices[address - 1].device_id)
+
+    def generic_command(self, device, command, data=0, timeout=0.0, check_errors=True):
+        replies = self._execute(device, command, data, schedule=False)
+        reply = replies[0]
+        if reply.command == zaber_sim.ERROR and check_errors:
+            raise RuntimeError('Command {} with data {} resulted in error code {}'.format(
+                zaber_daemon._code(command), data, reply.data))
+        return reply
+
+    def generic_command_no_response(self, device, command, data=0):
+        for reply in self._execute(device, command, data, schedule=True):
+            self.unknown_response.emit(reply)
+
+    def close(self):
+        self.clock.remove_listener(self._advance)
+
+    def _execute(self, device, command, data, schedule):
+        # Immediate replies, delayed move replies are queued when schedule is set
+        command = zaber_daemon._code(command)
+        t = self.clock.getTime()
+        replies = []
+        with self._lock:
+            for sim in self.devices:
+                if device not in (0, sim.device_number):
+                    continue
+                if command == zaber_sim.SET_TARGET_SPEED and data > self.max_speed:
+                    code, value, t_reply, move = zaber_sim.ERROR, zaber_sim.ERROR_SPEED_INVALID, t, None
+                else:
+                    code, value, t_reply, move = sim.handle(command, int(data), t)
+                reply = zaber_daemon.daemon_reply(sim.device_number, code, value)
+                if code == zaber_sim.ERROR:
+                    self.errors += 1
+                if schedule and move is not None and t_reply > t:
+                    self._seq += 1
+                    heapq.heappush(self._replies, (t_reply, self._seq, sim, move, reply))
+                else:
+                    replies.append(reply)
+        return replies
+
+    def _advance(self, t):
+        # Send the replies of the moves that finished by t, pre-empted moves do not reply
+        due = []
+        with self._lock:
+            while self._replies and self._replies[0][0] <= t:
+                t_reply, seq, sim, move, reply = heapq.heappop(self._replies)
+                if move == sim.move:
+                    due.append(reply)
+        for reply in due:
+            self.unknown_response.emit(reply)
+
+
+class virtual_recorder(zaber_tools.position_recorder):
+    """Position recorder sampled on the frames of a virtual clock."""
+
+    def __init__(self, zt, path, clock, rate=20.0, **kwargs):
+        super().__init__(zt, path, rate=rate, **kwargs)
+        self.clock = clock
+        self._t_next = None
+
+    def start(self):
+        if self._t_next is None:
+            self._t_next = self.clock.getTime()
+            self.clock.add_listener(self._tick)
+
+    def stop(self, timeout=2.0):
+        self.clock.remove_listener(self._tick)
+        self._t_next = None
+        self.buffer.flush()
+
+    def _tick(self, t):
+        if t < self._t_next:
+            return
+        self._sample(1. / self.rate)
+        self._t_next = max(self._t_next + 1. / self.rate, t)  # no bursts to catch up
+
+
+# ######################################################################
+# HEADLESS WINDOW
+# ######################################################################
+class headless_stim:
+    """Stimulus of a headless window, keeps its attributes and draws nothing."""
+
+    def __init__(self, win=None, text='', color='white', **kwargs):
+        # text and color always exist, as on a PsychoPy TextStim
+        self.win = win
+        self.text = text
+        self.color = color
+        self.__dict__.update(kwargs)
+
+    def draw(self, win=None):
+        pass
+
+
+class headless_window:
+    """Window that does not open, flips return at once."""
+
+    def __init__(self, size=(1280, 1024), **kwargs):
+        self.size = size
+        self.color = None
+        self.colorSpace = 'rgb'
+        self.monitorFramePeriod = 1. / 60
+        self.frames = 0
+        self.__dict__.update(kwargs)
+
+    def flip(self, clearBuffer=True):
+        self.frames += 1
+
+    def update(self):
+        self.flip()
+
+    def clearBuffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# replaces psychopy.visual in a headless dry run
+headless_visual = types.SimpleNamespace(Window=headless_window, Rect=headless_stim, TextStim=headless_stim,
+                                        BufferImageStim=headless_stim)
+
+
+def report(clock, connection, zt):
+    # Summary lines of a dry run: time and speed-up, travel and range used per axis
+    real = clock.real_time()
+    session = clock.getTime()
+    lines = ['Dry run: {:.1f} s of session in {:.1f} s ({:.0f}x real time), {} frames, {} Zaber errors'.format(
+        session, real, session / real if real > 0 else 0, clock.frames, connection.errors)]
+    for sim in connection.devices:
+        axis = sim.axis
+        start = connection.start_positions[sim.device_number]
+        lines.append('Dry run axis {}: {} moves, travel {:.1f} mm, range used {:+.1f} to {:+.1f} mm from the start '
+                     '(limits {:+.1f} to {:+.1f} mm)'.format(
+                         sim.device_number, axis.moves,
+                         zt.dist_mustep_to_mm(axis.travel, sim.device_number),
+                         zt.dist_mustep_to_mm(axis.low - start, sim.device_number),
+                         zt.dist_mustep_to_mm(axis.high - start, sim.device_number),
+                         zt.dist_mustep_to_mm(axis.min_position - start, sim.device_number),
+                         zt.dist_mustep_to_mm(axis.max_position - start, sim.device_number)))
+    return lines
@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 
 """Script to run an fMRI paradigm.
-The paradigm is hard-coded but some code is available to support reading from
-as CSV file. Just (un)comment the appropriate code.
+The paradigm is hard-coded below or read from a CSV or JSON Lines file (see
+uro_paradigm.read_paradigm and the paradigms folder). Compiled paradigm files
+are cached in ./paradigm-cache.
 """
 # Part of the URO library
 # Copyright (C) 2021 Pieter Vandemaele
@@ -19,6 +20,13 @@ import os
 import pathlib as pl
 import scannertrigger as s
 import zaber_tools
+import zaber_daemon
+import uro_paradigm
+import uro_logging
+import uro_dryrun
+import uro_selftest
+import uro_timing
+import uro_render
 from zaber_motion.binary import CommandCode, BinarySettings
 from zaber_motion import Units, FirmwareVersion, Measurement, Tools
 
@@ -27,8 +35,14 @@ from zaber_motion import Units, FirmwareVersion, Measurement, Tools
 # ######################################################################
 
 
+logsink = None
+
+
 def print_log(txt):
-    # PRINT
+    # PRINT, through the log sink once it runs so the caller never waits for the console
+    if logsink is not None:
+        logsink.console(txt)
+        return
     now = datetime.now()
     dt_string = now.strftime("%Y-%m-%d %H:%M:%S")
     print('> {} {}'.format(dt_string, txt))
@@ -50,9 +64,12 @@ expInfo = {
                            'dummy'],
             'skip scans': 0,
             'COM Port (MRI)': "COM1",
-            'COM Port (Zaber)': "COM9",
-            'Zaber': ['off', 'on']
-            # 'Paradigm from file': ['yes', 'no'],
+            'COM Port (Zaber)': "auto",  # auto: probe the serial ports
+            'Zaber': ['off', 'on'],
+            'Dry run': ['no', 'yes', 'headless'],  # accelerated clock and pump model, see uro_dryrun
+            'Paradigm from file': ['no', 'yes'],
+            'Overrun policy': ['catchup', 'shorten', 'abort'],
+            'Onset mode': ['flip', 'immediate'],  # move and log on the flip showing the condition
            }
 
 dlg = gui.DlgFromDict(dictionary=expInfo, title=expName, order=list(expInfo.keys()), sortKeys=False)
@@ -91,6 +108,9 @@ dur_withdraw = 5
 rate_infuse = 500
 rate_withdraw = 500
 
+# Lateness (s) above which an entry counts as late, see uro_paradigm.paradigm_scheduler
+overrun_tolerance = 0.1
+
 paradigm = [
     ['baseline', 'rest', dur_baseline, 'Baseline'],
     ['event 1',  'pause', dur_pause1, 'Event 1\nPause 1'],
@@ -118,35 +138,30 @@ col_command = {
     'infuse': (0.850980392, 0.37254902, 0.168627451),
     'withdraw': (0.48627451, 0.701960784, 0.243137255),
     }
-# paradigm_file = gui.fileOpenDlg(tryFilePath='', tryFileName='', prompt='Select file to open', allowed=None)
-#
-# if not paradigm_file:
-#     core.quit()
-# else:
-#     paradigm_file = paradigm_file[0]
-#
-# paradigm = []
-#
-# with open(paradigm_file) as csvfile:
-#     paradigmreader = csv.reader(csvfile, delimiter=',')
-#     paradigm = []
-#     for row in paradigmreader:
-#         row = [x.strip(' ') for x in row]
-#         row = [x.replace('\\n', '\n') for x in row]
-#         row[2] = int(row[2])
-#         if len(row)>4:
-#             row[4] = int(row[4])
-#         paradigm.append(row)
-#
-# print(paradigm)
 
+paradigm_file = None
+if expInfo['Paradigm from file'] == 'yes':
+    paradigm_file = gui.fileOpenDlg(tryFilePath='./paradigms', tryFileName='', prompt='Select file to open',
+                                    allowed='Paradigm files (*.csv *.jsonl)')
 
+    if not paradigm_file:
+        core.quit()
+    else:
+        paradigm_file = paradigm_file[0]
 
 # ######################################################################
 # PREPARE PSYCHOPY
 # ######################################################################
+# Dry run: virtual clock, dummy trigger and simulated pump instead of the device
+dry_run = expInfo['Dry run'] != 'no'
+dryrun_frame_interval = 1. / 60  # s of session time per frame
+dryrun_axes = 1
+
 # Global experiment clock
-global_clock = core.Clock()
+if dry_run:
+    global_clock = uro_dryrun.virtual_clock(dryrun_frame_interval)
+else:
+    global_clock = core.Clock()
 
 # Logging
 paradigm_loglevel = logging.FATAL+1
@@ -154,6 +169,52 @@ logging.addLevel(paradigm_loglevel, 'PARADIGM')
 logging.setDefaultClock(global_clock)
 logging.console.setLevel(logging.CRITICAL)
 
+# fsync policy of the log files, see uro_logging
+log_fsync = 'batch'
+
+# Pump position sampling rate (Hz) during the session, 0 disables the recorder
+telemetry_rate = 20
+# Time (s) after a move onset without position requests on the port, so the
+# move does not wait for a request in progress
+telemetry_hold = 0.05
+
+# Pipelined Zaber transport with message IDs, see zaber_tools.pipeline
+zaber_message_ids = False
+
+# Frames preallocated per second of paradigm for the frame timing record,
+# see uro_timing
+frame_log_rate = 240
+
+# Pre-flight self-test before the scanner trigger, the run does not start when
+# a check is out of spec; thresholds override uro_selftest.DEFAULT_THRESHOLDS,
+# eg {'frame_p99_ms': 20}
+selftest = True
+selftest_thresholds = {}
+
+# Live flow pane: refresh interval (s), rate smoothing window (s) and the
+# fraction of the planned rate below which a move is flagged as stalled
+flow_refresh = 0.25
+flow_window = 0.5
+flow_stall_fraction = 0.5
+
+# Dashboard: static boxes and headers drawn once into a cached layer, GPU time
+# per frame measured with timer queries (see uro_render)
+dashboard_cache = True
+dashboard_gpu_timing = False
+
+# Countdown: frames where no text changed are not drawn nor flipped, the loop
+# still wakes up every frame period to poll the keys
+idle_flip_suppression = True
+
+# Countdown values laid out at startup up to the longest paradigm entry, capped
+# at countdown_sprites_max (s); longer countdowns lay out their text when shown
+countdown_sprites = True
+countdown_sprites_max = 900
+
+# Dashboard states of the session (command texts and colours, flow pane,
+# countdown values) drawn offscreen once before the trigger, see uro_render.warm_up
+gl_warmup = True
+
 sub = expInfo['subject ID']
 ses = expInfo['session ID']
 
@@ -166,8 +227,12 @@ if ses is str:
 curdir = pl.Path('.')
 logdir = pl.Path('.', 'log')
 logtime = datetime.now().strftime('%Y%m%d_%H%M%S')
+if dry_run:
+    logtime += '_dryrun'
 logfname = 'sub-{}_ses-{}_{}.txt'.format(sub, ses, logtime)
 logfname1 = 'sub-{}_ses-{}_{}_all.txt'.format(sub, ses, logtime)
+telemetryfname = 'sub-{}_ses-{}_{}_position.npy'.format(sub, ses, logtime)
+framesfname = 'sub-{}_ses-{}_{}_frames.npy'.format(sub, ses, logtime)
 
 if not logdir.exists():
     try:
@@ -177,12 +242,15 @@ if not logdir.exists():
         core.quit()
 
 try:
-    logData = logging.LogFile(str(pl.Path(logdir, logfname1).resolve()),
-                              filemode='w',
-                              level=logging.INFO)
-    logParadigm = logging.LogFile(str(pl.Path(logdir, logfname).resolve()),
-                                  filemode='w',
-                                  level=paradigm_loglevel)
+    # Both files are written by a background thread, messages logged through
+    # psychopy.logging reach them on logging.flush()
+    logsink = uro_logging.log_sink(global_clock.getTime, fsync=log_fsync)
+    logData = logsink.add_file(str(pl.Path(logdir, logfname1).resolve()),
+                               level=logging.INFO,
+                               logger=logging.root)
+    logParadigm = logsink.add_file(str(pl.Path(logdir, logfname).resolve()),
+                                   level=paradigm_loglevel,
+                                   logger=logging.root)
 
 except Exception as e:
     print_log("LOGGING ERROR: {0}".format(e))
@@ -191,8 +259,14 @@ except Exception as e:
 print_log('Logging to file {}'.format(pl.Path(logdir, logfname).absolute()))
 
 # Window
+if expInfo['Dry run'] == 'headless':
+    visual = uro_dryrun.headless_visual
 win = visual.Window([1280, 1024], monitor="testMonitor", units="norm")
+if dry_run:
+    # every flip moves the virtual clock on by a frame
+    uro_dryrun.attach_window(win, global_clock)
 win.update()
+frame_period = getattr(win, 'monitorFramePeriod', 1. / 60)
 
 # ######################################################################
 # DASHBOARD
@@ -217,6 +291,7 @@ col_paneHdr = (75, 100, 129)
 col_paneBox = (48, 63, 81)
 col_panetitletext = (1, 1, 1)
 col_panebodytext = (1, 1, 1)
+col_flow_alert = np.array(col_lut['red']) / 255.
 
 win.colorSpace = 'rgb255'
 win.color = col_background
@@ -431,6 +506,9 @@ txt_cntrBox = visual.TextStim(
     pos=txt_cntrBox_pos,
     height=0.4, alignText='center', text="10", wrapWidth=txt_cntrBox_wrap)
 
+# countdown values drawn from stimuli laid out once, see RUN EXPERIMENT
+cntr_sprites = uro_render.number_sprites(txt_cntrBox, visual_module=visual)
+
 # ## COPYRIGHT
 # ### RECTANGLES
 
@@ -441,6 +519,16 @@ txt_copyr = visual.TextStim(
     height=0.05, alignText='left', text="(C) 2021 Pieter Vandemaele", wrapWidth=txt_copyr_wrap)
 
 
+# ## LAYERS
+# only the flow, command and timer text change during the session
+dashboard = uro_render.layered_dashboard(
+    win,
+    static=[rect_titleBox, txt_titleBox, txt_copyr,
+            rect_flowBox, rect_flowHdr, rect_cmdBox, rect_cmdHdr, rect_cntrBox, rect_cntrHdr,
+            txt_flowHdr, txt_cmdHdr, txt_cntrHdr],
+    dynamic=[txt_flowBox, txt_cmdBox, cntr_sprites],
+    cache=dashboard_cache, gpu_timing=dashboard_gpu_timing, visual_module=visual)
+
 # ######################################################################
 # OTHER GRAPHICAL COMPONENTS
 # ######################################################################
@@ -468,47 +556,157 @@ txt_endofsession = visual.TextStim(
 # ######################################################################
 
 
-def process_paradigm(paradigm):
-    #    0: event
-    #    1: command
-    #    2: duration
-    #    3: info
-    #    4: rate
-
-    for entry in paradigm:
-        event = entry[0]
-        command = entry[1]
-        duration = entry[2]
-        info = entry[3]
+def process_paradigm(paradigm, paradigm_file=None):
+    # Compile the paradigm rows into a structured array, see uro_paradigm
+    # A paradigm file goes through the compile cache, returns the paradigm and
+    # whether the cache was hit
+    # entries are validated against the axes found on the port
+    if zaber_on:
+        device = dict(microstep_size=zt.zb_microstep_sizes,
+                      max_velocity={a: zt.vel_mm_per_s_to_vel(zt.zb_max_speed, a) for a in zt.devices})
+    else:
+        device = {}
 
-        if len(entry) > 4:
-            rate = entry[4]
+    if paradigm_file is None:
+        return uro_paradigm.compile_paradigm(paradigm, **device), None
 
-            if zaber_on:
-                distance_mustep = zt.dist_mm_to_mustep(duration*rate/60)
-                velocity_mustep = int(ceil(zt.vel_mm_per_s_to_vel(rate/60)))
-                distance_mm = duration*rate/60
-            else:
-                distance_mustep = 0
-                velocity_mustep = 0
-                distance_mm = duration*rate/60
-
-            if command == 'infuse':
-                distance_mustep = abs(distance_mustep)
-                distance_mm = abs(distance_mm)
-            elif command == 'withdraw':
-                distance_mustep = -abs(distance_mustep)
-                distance_mm = -abs(distance_mm)
-
-            entry.append([distance_mm, distance_mustep, velocity_mustep])
-    return paradigm
-
-
-def present_condition(win, start_time, entry, countdown):
-    name = entry[0]
-    command = entry[1]
-    duration = entry[2]
-    info = entry[3]
+    if zaber_on:
+        device['microstep_resolution'] = zt.zb_microstep_resolutions
+    return uro_paradigm.load_paradigm(paradigm_file, **device)
+
+
+def stage_movement(entry):
+    # Send the target speed of an upcoming infuse/withdraw ahead of its onset,
+    # the device must be idle as the speed also applies to a running move;
+    # nothing is sent when the axis already runs at this speed
+    return zt.set_setting(int(entry['axis']), CommandCode.SET_TARGET_SPEED, int(entry['velocity']))
+
+
+def start_move(entry, speed=False):
+    # Relative move of the axis of the entry, all axes start from one broadcast packet
+    # speed: send the target speed in the same burst as the move
+    axis = int(entry['axis'])
+    if axis == uro_paradigm.AXIS_ALL:
+        if speed:
+            stage_movement(entry)
+        return zt.move_broadcast(CommandCode.MOVE_RELATIVE, int(entry['microsteps']))
+    if speed:
+        return zt.move_with_settings(axis, int(entry['microsteps']), speed=int(entry['velocity']))
+    return zt.move_relative(int(entry['microsteps']), device=axis)
+
+
+def is_movement(entry):
+    return entry is not None and uro_paradigm.is_movement(entry['command'])
+
+
+def start_flow(move, distance_mm, rate):
+    # State of the live flow pane for a move, None without position feedback
+    if move is None or recorder is None or recorder.samples == 0:
+        return None
+    devices = move.device if isinstance(move.device, tuple) else (move.device,)
+    if recorder.device not in devices:
+        return None  # the recorder follows another axis
+    return {'move': move,
+            'planned_mm': distance_mm,
+            'rate': rate,
+            't_onset': global_clock.getTime(),
+            'pos0': int(recorder.latest(1)['position'][0]),
+            't_refresh': -np.inf,
+            'text': None}
+
+
+def update_flow(flow, now):
+    # Refresh the flow pane from the position feedback, throttled to flow_refresh
+    # Returns True when the pane changed
+    if flow is None or now - flow['t_refresh'] < flow_refresh:
+        return False
+    flow['t_refresh'] = now
+
+    achieved_mm = zt.dist_mustep_to_mm(int(recorder.latest(1)['position'][0]) - flow['pos0'], recorder.device)
+    velocity = recorder.velocity(flow_window)
+    age = recorder.age(now)
+    alert = False
+    if velocity is None or age is None or age > flow_window:
+        rate_txt = 'Rate: no feedback'
+        alert = not flow['move'].done()
+    else:
+        # same unit as the planned rate
+        achieved_rate = abs(zt.dist_mustep_to_mm(velocity, recorder.device)) * 60
+        rate_txt = 'Rate: {:.0f} / {:g} ml/s'.format(achieved_rate, flow['rate'])
+        if (not flow['move'].done() and now - flow['t_onset'] > flow_window
+                and achieved_rate < flow_stall_fraction * flow['rate']):
+            rate_txt += '\nSTALLED' if achieved_rate < 0.05 * flow['rate'] else '\nSLOW'
+            alert = True
+
+    text = 'Volume: {:.1f} / {:.1f} ml\n{}'.format(achieved_mm, flow['planned_mm'], rate_txt)
+    if text == flow['text']:
+        return False
+    flow['text'] = text
+    txt_flowBox.text = text
+    txt_flowBox.color = col_flow_alert if alert else 'white'
+    return True
+
+
+def idle_until(t):
+    # Wait until clock time t without flipping, a dry run advances its clock instead
+    if dry_run:
+        global_clock.advance_to(t)
+    else:
+        time.sleep(max(0., t - global_clock.getTime()))
+
+
+def dashboard_state(cmd_text, cmd_color, flow_text, flow_color, value=None):
+    # Function that sets the command pane, the flow pane and the timer
+    def apply():
+        txt_cmdBox.text = cmd_text
+        txt_cmdBox.color = cmd_color
+        txt_flowBox.text = flow_text
+        txt_flowBox.color = flow_color
+        if value is not None:
+            cntr_sprites.set_value(value)
+    return apply
+
+
+def warmup_states(paradigm, n_values=10):
+    # Dashboard states of the session: the command text of every entry in its
+    # colour and every colour of col_command, the flow pane of every entry and
+    # its live and alert variants, a sample of countdown values
+    states = []
+    seen = set()
+
+    def add(*state):
+        if state not in seen:
+            seen.add(state)
+            states.append(dashboard_state(*state))
+
+    longest = int(ceil(paradigm['duration'].max()))
+    values = np.unique(np.linspace(0, longest, n_values).astype(int))
+    for k, entry in enumerate(paradigm):
+        command = uro_paradigm.command_name(entry['command'])
+        distance_mm, rate = (entry['mm'], entry['rate']) if is_movement(entry) else (0, 0)
+        add(entry['info'], col_command.get(command, (0, 0, 0)),
+            'Volume: {:.1f} ml\nRate: {:g} ml/s'.format(distance_mm, rate), 'white', int(values[k % len(values)]))
+        if is_movement(entry):
+            volume_txt = 'Volume: {:.1f} / {:.1f} ml\n'.format(distance_mm, distance_mm)
+            add(entry['info'], col_command.get(command, (0, 0, 0)),
+                volume_txt + 'Rate: {:.0f} / {:g} ml/s'.format(rate, rate), 'white')
+    info = paradigm[0]['info']
+    for color in col_command.values():
+        add(info, color, 'Volume: 0.0 ml\nRate: 0 ml/s', 'white')
+    for rate_txt in ('Rate: no feedback', 'Rate: 0 / 100 ml/s\nSTALLED', 'Rate: 10 / 100 ml/s\nSLOW'):
+        add(info, col_command.get('infuse', (0, 0, 0)), 'Volume: 0.0 / 10.0 ml\n' + rate_txt, tuple(col_flow_alert))
+    for value in values:
+        add(info, col_command.get('rest', (0, 0, 0)), 'Volume: 0.0 ml\nRate: 0 ml/s', 'white', int(value))
+    return states
+
+
+def present_condition(win, start_time, end_time, entry, countdown, staged=None, next_entry=None, idx=-1):
+    # staged: speed command sent for this entry during the previous pause
+    # idx: index of the entry, tags the frames in the frame log
+    # returns whether to continue and the staged speed command for next_entry
+    name = entry['event']
+    command = uro_paradigm.command_name(entry['command'])
+    info = entry['info']
     txt_cmdBox.text = info
 
     try:
@@ -516,69 +714,145 @@ def present_condition(win, start_time, entry, countdown):
     except:
         txt_cmdBox.color = (0, 0, 0)
 
-    end_time = start_time + duration
+    if is_movement(entry):
+        rate = entry['rate']
+        distance_mm = entry['mm']
+    else:
+        distance_mm = 0
+        rate = 0
+    txt_flowBox.text = 'Volume: {:.1f} ml\nRate: {:g} ml/s'.format(distance_mm, rate)
+    txt_flowBox.color = 'white'
 
-    logstr = '{}, {}, {}, {:.3f}, {:.3f}'.format(name, command, info.replace("\n", " "), start_time, global_clock.getTime())
-    logging.data(logstr)
-    logging.log(logstr, paradigm_loglevel)
+    onset = {'visual': None, 'move': None, 'speed_staged': False}
 
-    # start movement
-    if (command == 'infuse' or command == 'withdraw'):
-        rate = entry[4]
-        distance_mm = entry[5][0]
-        distance_mustep = entry[5][1]
-        velocity_mustep = entry[5][2]
+    def start_onset():
+        # log line and movement of the condition
+        # the render thread only queues pre-timestamped records
+        t_now = global_clock.getTime()
+        logstr = '{}, {}, {}, {:.3f}, {:.3f}'.format(name, command, info.replace("\n", " "), start_time, t_now)
+        logsink.log(logstr, paradigm_loglevel, t_now)
 
-        if zaber_on:
+        if is_movement(entry) and zaber_on:
             try:
-                reply = zt.connection.generic_command(1, CommandCode.SET_TARGET_SPEED, velocity_mustep,  timeout=0)
-                zt.connection.generic_command_no_response(1, CommandCode.MOVE_RELATIVE,  distance_mustep)
+                # queued on the Zaber dispatcher, the render thread does not wait for the port
+                # only the move goes out at onset when the speed was staged
+                onset['speed_staged'] = staged is not None and staged.error is None
+                onset['move'] = start_move(entry, speed=not onset['speed_staged'])
             except Exception as e:
                 logging.error('Zaber command failed')
                 logging.flush()
                 print_log("ZABER ERROR: {0}".format(e))
                 core.quit()
+
+    def mark_visual():
+        onset['visual'] = global_clock.getTime()
+
+    win.callOnFlip(mark_visual)
+    shown = expInfo['Onset mode'] == 'flip'
+    if shown:
+        # the condition appears on the predicted flip closest to start_time,
+        # the log line and the move go out right after that flip
+        t_onset = uro_timing.predict_flip(frames.last_flip, frame_period, global_clock.getTime(), start_time)
+        idle_until(t_onset - frame_period / 2)
+        win.callOnFlip(start_onset)
+        cntr_sprites.set_value(ceil(end_time - t_onset))
+        draw_dashboard()
+        t_flip = win.flip()
+        frames.record(global_clock.getTime() if t_flip is None else t_flip, idx)
     else:
-        distance_mm = 0
-        rate = 0
+        start_onset()
+    move = onset['move']
+    speed_staged = onset['speed_staged']
 
-    logging.flush()
-    txt_flowBox.text = 'Volume: {:.1f} ml\nRate: {} ml/s'.format(distance_mm, rate)
-    print_log('---> Presenting event: {} | command: {} | volume: {} ml | velocity {} ml/s'.format(name, command, distance_mm, rate))
+    # the device is idle during a pause, preload the next movement
+    next_staged = None
+    if not is_movement(entry) and zaber_on and is_movement(next_entry):
+        try:
+            next_staged = stage_movement(next_entry)
+        except Exception as e:
+            logsink.log('Zaber staging failed, speed will be sent at onset: {}'.format(e), logging.WARNING)
+
+    flow = start_flow(move, distance_mm, rate)
+    print_log('---> Presenting event: {} | command: {} | volume: {} ml | velocity {:g} ml/s'.format(name, command, distance_mm, rate))
 
     go = True
     if countdown:
+        dirty = not shown  # command and flow text of the new condition
+        t_frame = global_clock.getTime()
         while global_clock.getTime() < end_time and go:
-            txt_cntrBox.text = str(ceil(end_time - global_clock.getTime()))
-
-            draw_dashboard()
-            win.update()
+            t_now = global_clock.getTime()
+            # the timer swaps to a prepared stimulus, text is only laid out for values beyond the cache
+            dirty = cntr_sprites.set_value(ceil(end_time - t_now)) or dirty
+            dirty = update_flow(flow, t_now) or dirty
+
+            if dirty or not idle_flip_suppression:
+                draw_dashboard()
+                t_flip = win.flip()
+                t_frame = global_clock.getTime() if t_flip is None else t_flip
+                frames.record(t_frame, idx)
+                dirty = False
+            else:
+                # the screen keeps the last flip, sleep to the next frame
+                t_frame = max(t_frame + frame_period, t_now)
+                idle_until(min(t_frame, end_time))
+                frames.record(global_clock.getTime(), idx, flipped=False)
 
             pressed = event.getKeys(keyList=["escape"])
             if len(pressed) > 0:
                 go = False
-    else:
+    elif not shown:
         draw_dashboard()
         win.update()
 
-    # wait for device if still busy
-    if zaber_on:
-        while zt.device.is_busy() and go:
-            pressed = event.getKeys(keyList=["escape"])
-            if len(pressed) > 0:
-                go = False
-            pass
+    def poll():
+        # keep the flow pane live while the move overruns the condition,
+        # in a dry run every poll is a frame as only frames advance the clock
+        if update_flow(flow, global_clock.getTime()) or dry_run:
+            draw_dashboard()
+            win.update()
+        return len(event.getKeys(keyList=["escape"])) == 0
 
-    if not go:
+    # wait for device if still busy, the move completes on the device reply
+    if move is not None and go:
         try:
-            zt.device.stop()
+            go = zt.wait_move(move, poll=poll, interval=0 if dry_run else 0.005)
+        except Exception as e:
+            logging.error('Zaber move failed')
+            logging.flush()
+            print_log("ZABER ERROR: {0}".format(e))
+            core.quit()
+
+        speed_errors = [staged.error] if speed_staged else move.setting_errors
+        for error in [e for e in speed_errors if e is not None]:
+            logsink.log('Zaber set target speed failed: {}'.format(error), logging.ERROR)
+            print_log("ZABER ERROR: {0}".format(error))
+
+        if move.done():
+            onset_latency = move.start_time - start_time
+            onset_latencies.append(onset_latency)
+            # device onset after the visual onset (the first flip of the condition)
+            t_visual = np.nan if onset['visual'] is None else onset['visual']
+            onset_residual = move.start_time - t_visual
+            onset_residuals.append(onset_residual)
+            logstr = '{}, {}, axis {}, move sent, {:.3f}, onset latency, {:.4f}, visual onset, {:.3f}, onset residual, {:.4f}, speed staged, {}, move finished, {:.3f}, {} transactions'.format(
+                name, command, entry['axis'], move.start_time, onset_latency, t_visual, onset_residual, speed_staged,
+                move.end_time, move.transactions)
+            logsink.log(logstr, logging.DATA, move.end_time)
+            print_log('---> Move onset latency {:.1f} ms, {:.1f} ms after the visual onset (speed staged: {}) | finished after {:.3f} s | {} serial transactions'.format(
+                onset_latency*1000, onset_residual*1000, speed_staged, move.duration(), move.transactions))
+
+    if not go and zaber_on:
+        try:
+            zt.stop(int(entry['axis']))
         except Exception as e:
             logging.error('Zaber command failed')
             logging.flush()
             print_log("ZABER ERROR: {0}".format(e))
             core.quit()
 
-    return go
+    # hand the messages PsychoPy logged itself to the log sink, this only queues them
+    logging.flush()
+    return go, next_staged
 
 
 def draw_hdr_ftr():
@@ -589,20 +863,8 @@ def draw_hdr_ftr():
 
 
 def draw_dashboard():
-    draw_hdr_ftr()
-    rect_flowBox.draw()
-    rect_flowHdr.draw()
-    rect_cmdBox.draw()
-    rect_cmdHdr.draw()
-    rect_cntrBox.draw()
-    rect_cntrHdr.draw()
-
-    txt_flowHdr.draw()
-    txt_flowBox.draw()
-    txt_cmdHdr.draw()
-    txt_cmdBox.draw()
-    txt_cntrHdr.draw()
-    txt_cntrBox.draw()
+    # cached boxes, title and headers, then the flow, command and timer text
+    dashboard.draw()
 
 # ######################################################################
 # SCANNER TRIGGER SETUP
@@ -627,7 +889,7 @@ txt_scannertrigger = visual.TextStim(
     )
 
 # Setup scanner trigger configuration
-portType = expInfo['triggering']
+portType = 'dummy' if dry_run else expInfo['triggering']
 dummyScans = int(expInfo['skip scans'])
 comPort_MRI = expInfo['COM Port (MRI)']
 if portType == "keyboard":
@@ -699,7 +961,8 @@ except Exception as e:
     txt_scannertrigger.draw()
     win.update()
     print_log("SCANNERTRIGGER ERROR: {0}".format(e))
-    event.waitKeys()
+    if not dry_run:
+        event.waitKeys()
     core.quit()
 
 logging.info('ScannerTrigger connection established')
@@ -713,7 +976,7 @@ print_log('Setting up Zaber')
 logging.info('Open Zaber connection')
 
 # Zaber connection feedback
-zaber_on = expInfo['Zaber'] == 'on'
+zaber_on = expInfo['Zaber'] == 'on' or dry_run
 
 txt_zaber = visual.TextStim(
     win=win,
@@ -734,12 +997,28 @@ comPort_Zaber = expInfo['COM Port (Zaber)']
 
 # OPEN A ZABER CONNECTION
 try:
-    if zaber_on:
-        zt = zaber_tools.zaber_tools(comPort_Zaber)
+    if dry_run:
+        comPort_Zaber = 'dry run'
+        pump = uro_dryrun.pump_connection(global_clock, axes=dryrun_axes)
+        zt = zaber_tools.zaber_tools(comPort_Zaber, clock=global_clock.getTime, connection=pump)
+        # a frame only starts once the commands queued in the previous one went out
+        global_clock.add_barrier(zt.dispatcher.wait_idle)
+        txt_zaber.text = 'Dry run\nSimulated pump with {} axes'.format(dryrun_axes)
+        print_log('\tDry run with a simulated pump ({} axes)'.format(dryrun_axes))
+    elif zaber_on:
+        # use the Zaber daemon when it is running, it keeps the port open
+        comPort_Zaber = zaber_daemon.zaber_port(comPort_Zaber)
+        if comPort_Zaber == 'auto':
+            # probe every serial port except the one of the scanner trigger
+            comPort_Zaber, _ = zaber_tools.discover_port(exclude=[comPort_MRI])
+            print_log('\tFound Zaber on {}'.format(comPort_Zaber))
+        zt = zaber_tools.zaber_tools(comPort_Zaber, clock=global_clock.getTime, message_ids=zaber_message_ids)
         # device id
-        resp = zt.connection.generic_command(1, CommandCode.RETURN_SETTING,  50, timeout=0.0, check_errors=True)
-        txt_zaber.text = 'Connected to Zaber on {}\Device ID: {}'.format(comPort_Zaber, resp.data)
-        print_log('\tConnected to Zaber on {}\Device ID: {}'.format(comPort_Zaber, resp.data))
+        device_id = zt.get_setting(1, 50)
+        txt_zaber.text = 'Connected to Zaber on {}\Device ID: {}'.format(comPort_Zaber, device_id)
+        print_log('\tConnected to Zaber on {}\Device ID: {}'.format(comPort_Zaber, device_id))
+        print_log('\tZaber connect {:.1f} ms ({})'.format(
+            zt.connect_time() * 1000, 'snapshot' if zt.snapshot_hit else 'full discovery'))
     else:
         txt_zaber.text = 'Running in emulation mode\nZaber connection bypassed'
         print_log('\tRunning in emulation mode')
@@ -752,7 +1031,8 @@ except Exception as e:
     txt_zaber.draw()
     win.update()
     print_log("ZABER ERROR: {0}".format(e))
-    event.waitKeys()
+    if not dry_run:
+        event.waitKeys()
     core.quit()
 
 logging.info('Zaber connection established')
@@ -762,17 +1042,103 @@ print_log('\tZaber connection established')
 draw_hdr_ftr()
 txt_zaber.draw()
 win.update()
-event.waitKeys()
+if not dry_run:
+    event.waitKeys()
 
 # ######################################################################
 # RUN EXPERIMENT
 # ######################################################################
 print_log('Processing paradigm')
-paradigm = process_paradigm(paradigm)
+try:
+    t_compile = time.perf_counter()
+    paradigm, cache_hit = process_paradigm(paradigm, paradigm_file)
+    t_compile = (time.perf_counter() - t_compile)*1000
+    if paradigm_file is None:
+        print_log('\tCompiled {} entries in {:.2f} ms'.format(len(paradigm), t_compile))
+    else:
+        logstr = 'Paradigm {}: cache {}, {} entries in {:.2f} ms'.format(
+            paradigm_file, 'hit' if cache_hit else 'miss', len(paradigm), t_compile)
+        logging.info(logstr)
+        print_log('\t' + logstr)
+except (ValueError, OSError) as e:
+    logging.error('Paradigm validation failed')
+    logging.flush()
+    print_log("PARADIGM ERROR: {0}".format(e))
+    core.quit()
+
+if countdown_sprites and len(paradigm) > 0:
+    n_sprites = min(int(ceil(paradigm['duration'].max())), countdown_sprites_max)
+    cntr_sprites.prepare(n_sprites)
+    logstr = 'Countdown sprites: values 0 to {} prepared in {:.1f} ms'.format(n_sprites, cntr_sprites.warmup_time*1000)
+    logging.info(logstr)
+    print_log('\t' + logstr)
+
+# ######################################################################
+# GL WARM-UP
+# ######################################################################
+# the first draw of a text or colour compiles shaders, renders glyphs and
+# uploads textures, done here instead of on the first events after the trigger;
+# a headless window has nothing to warm up
+if gl_warmup and len(paradigm) > 0 and expInfo['Dry run'] != 'headless':
+    print_log('Warming up the dashboard')
+    restore = dashboard_state(txt_cmdBox.text, txt_cmdBox.color, txt_flowBox.text, txt_flowBox.color)
+    t_warmup = time.perf_counter()
+    warmup = uro_render.warm_up(win, warmup_states(paradigm), draw_dashboard)
+    t_warmup = (time.perf_counter() - t_warmup)*1000
+    restore()
+    logstr = 'GL warm-up: {} states in {:.0f} ms, first frame max {:.1f} ms (mean {:.1f} ms) cold, max {:.1f} ms (mean {:.1f} ms) warm'.format(
+        warmup.shape[1], t_warmup, warmup[0].max()*1000, warmup[0].mean()*1000, warmup[-1].max()*1000, warmup[-1].mean()*1000)
+    logging.info(logstr)
+    print_log('\t' + logstr)
+
+# ######################################################################
+# PRE-FLIGHT SELF-TEST
+# ######################################################################
+txt_selftest = visual.TextStim(
+    win=win,
+    name='text',
+    text='',
+    font='Arial',
+    pos=(0, -0.6),
+    height=0.05,
+    wrapWidth=None,
+    ori=0,
+    color='white',
+    colorSpace='rgb',
+    opacity=1,
+    depth=0.0
+    )
+
+if selftest:
+    print_log('Running self-test')
+    checks = uro_selftest.run_self_test(win, zt if zaber_on else None,
+                                        poll=lambda: event.getKeys(keyList=["escape"]),
+                                        draw=draw_dashboard, thresholds=selftest_thresholds)
+    for logstr in uro_selftest.report(checks):
+        logging.info('Self-test: ' + logstr)
+        print_log('\t' + logstr)
+    failed = [check[0] for check in checks if not check[3]]
+    logstr = 'Self-test {}'.format('failed: ' + ', '.join(failed) if failed else 'passed')
+    logging.log(logstr, paradigm_loglevel)
+    logging.flush()
+    print_log(logstr)
+    txt_selftest.text = '\n'.join([logstr] + uro_selftest.report(checks))
+
+    if failed:
+        logging.error('Self-test out of spec, session not started')
+        logging.flush()
+        draw_hdr_ftr()
+        txt_selftest.color = 'red'
+        txt_selftest.draw()
+        win.flip()
+        if not dry_run:
+            event.waitKeys()
+        core.quit()
 
 print_log('Starting paradigm')
 draw_hdr_ftr()
 txt_scannertrigger.draw()
+txt_selftest.draw()
 win.flip()
 
 # SCANNER SYNCHRONIZATION
@@ -796,30 +1162,124 @@ except Exception as e:
 
 # MAIN LOOP
 ################################################################################
+recorder = None
+if zaber_on and telemetry_rate > 0:
+    try:
+        if dry_run:
+            recorder = uro_dryrun.virtual_recorder(zt, pl.Path(logdir, telemetryfname), global_clock,
+                                                   rate=telemetry_rate)
+        else:
+            recorder = zaber_tools.position_recorder(zt, pl.Path(logdir, telemetryfname), rate=telemetry_rate)
+        recorder.start()
+        print_log('Recording pump position at {} Hz to {}'.format(telemetry_rate, telemetryfname))
+    except Exception as e:
+        recorder = None
+        logging.warning('Position recorder could not be started: {}'.format(e))
+        print_log("TELEMETRY ERROR: {0}".format(e))
+
+# every flip of the countdown, room for overruns
+paradigm_duration = paradigm['onset'][-1] + paradigm['duration'][-1] if len(paradigm) > 0 else 0
+frames = uro_timing.frame_log(int(paradigm_duration * 1.5 * frame_log_rate) + 1000, frame_period=frame_period)
+
 time_offset = global_clock.getTime()
-tt = time_offset
 countdown = True
+cpu_start = (time.process_time(), time.perf_counter())
+staged = None
+onset_latencies = []
+onset_residuals = []
+
+# every onset is absolute from the trigger, overruns are absorbed by the policy
+scheduler = uro_paradigm.paradigm_scheduler(paradigm, time_offset,
+                                            policy=expInfo['Overrun policy'],
+                                            tolerance=overrun_tolerance)
+
+for idx, entry in enumerate(paradigm):
+    slot = scheduler.slot(idx, global_clock.getTime())
+    if slot is None:
+        logstr = 'Experiment aborted: {} started {:.3f} s late'.format(entry['event'], scheduler.lateness()[idx])
+        logging.error(logstr)
+        print_log(logstr)
+        break
 
-for entry in paradigm:
-    # Prepare Zaber
-    duration = entry[2]
-    start_time = time_offset
-    time_offset += entry[2]
-#   color = col_command[entry[1]]
-    command = entry[1]
-    info = entry[3]
+    start_time, end_time = slot
+    next_entry = paradigm[idx + 1] if idx + 1 < len(paradigm) else None
+    if recorder is not None and is_movement(next_entry):
+        # the next move starts on the flip closest to end_time
+        recorder.hold(end_time - frame_period / 2, end_time + telemetry_hold)
 
 #    present_condition(win, start_time, *entry[1:4], countdown)
-    go = present_condition(win, start_time, entry, countdown)
+    go, staged = present_condition(win, start_time, end_time, entry, countdown, staged, next_entry, idx)
+
+    overrun = scheduler.finished(idx, global_clock.getTime())
+    if overrun > overrun_tolerance:
+        logsink.log('{} overran its end by {:.3f} s'.format(entry['event'], overrun), logging.WARNING)
+        print_log('---> Overrun of {:.3f} s'.format(overrun))
 
     if not go:
         logging.info('Experiment aborted manually')
         print_log('Experiment aborted manually')
         break
 
+schedule_report = scheduler.report()
+for logstr in schedule_report:
+    logging.data(logstr)
+if len(schedule_report) > 0:
+    logging.log(schedule_report[-1], paradigm_loglevel)
+    print_log(schedule_report[-1])
+
+# CPU time of all threads over the wall time of the paradigm
+cpu_load = (time.process_time() - cpu_start[0]) / max(time.perf_counter() - cpu_start[1], 1e-9)
+logging.info('CPU load during the paradigm: {:.0f}%'.format(cpu_load * 100))
+print_log('CPU load during the paradigm: {:.0f}%'.format(cpu_load * 100))
+
+frames.save(pl.Path(logdir, framesfname))
+frame_report = frames.report(paradigm)
+for logstr in frame_report:
+    logging.data(logstr)
+if len(frame_report) > 0:
+    logging.log(frame_report[-1], paradigm_loglevel)
+    print_log('{} (frames in {})'.format(frame_report[-1], framesfname))
+
+logstr = dashboard.report()
+logging.info(logstr)
+print_log(logstr)
+
+if cntr_sprites.misses > 0:
+    logstr = 'Countdown sprites: {} values beyond the cache laid out as text'.format(cntr_sprites.misses)
+    logging.info(logstr)
+    print_log(logstr)
+
+if len(onset_latencies) > 0:
+    logstr = 'Move onset latency: mean {:.1f} ms, max {:.1f} ms over {} moves'.format(
+        np.mean(onset_latencies)*1000, np.max(onset_latencies)*1000, len(onset_latencies))
+    logging.info(logstr)
+    print_log(logstr)
+    logstr = 'Move onset after the visual onset ({} onset): mean {:.1f} ms, max {:.1f} ms'.format(
+        expInfo['Onset mode'], np.nanmean(onset_residuals)*1000, np.nanmax(onset_residuals)*1000)
+    logging.info(logstr)
+    print_log(logstr)
+
+if recorder is not None:
+    recorder.stop()
+    logstr = 'Position telemetry: {} samples, {} skipped while commands were queued, {} held around move onsets, {} failed'.format(
+        recorder.samples, recorder.skipped, recorder.held, recorder.errors)
+    logging.info(logstr)
+    print_log(logstr)
+
+if dry_run:
+    for logstr in uro_dryrun.report(global_clock, pump, zt):
+        logging.log(logstr, paradigm_loglevel)
+        print_log(logstr)
+
 try:
     if zaber_on:
-        zt.connection.close()
+        logstr = 'Zaber settings cache: {} round-trips saved ({} writes and {} reads skipped)'.format(
+            zt.settings_saved(), zt.settings_stats['saved_writes'], zt.settings_stats['saved_reads'])
+        logging.info(logstr)
+        print_log(logstr)
+        if dry_run:
+            global_clock.remove_barrier(zt.dispatcher.wait_idle)
+        zt.close()
 
 except Exception as e:
     logging.error('Zaber command failed')
@@ -841,6 +1301,8 @@ draw_hdr_ftr()
 txt_endofsession.draw()
 win.update()
 event.clearEvents()
-event.waitKeys()
+if not dry_run:
+    event.waitKeys()
 print_log('Experiment finished')
 logging.flush()
+logsink.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Asynchronous log writer for the URO tools.
+The render thread only puts pre-timestamped records on a bounded queue, a
+background thread formats them, writes them in batches and syncs the files
+to disk according to the fsync policy:
+- 'batch': fsync after every batch, a crash loses at most the batch in flight
+- 'interval': fsync at most every fsync_interval seconds
+- 'none': flush to the OS only
+The log files can also be registered as PsychoPy logging targets, messages
+logged through psychopy.logging then end up in the same files when
+logging.flush() is called.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from psychopy import logging
+
+FSYNC_POLICIES = ('batch', 'interval', 'none')
+
+
+class log_file:
+    """Log file written by a log_sink, usable as a PsychoPy logging target."""
+
+    def __init__(self, sink, path, level, filemode='w', encoding='utf8'):
+        self.sink = sink
+        self.path = path
+        self.level = level
+        self.handle = open(path, filemode, encoding=encoding)
+        self.stream = None  # PsychoPy only flushes targets with a stream
+
+    def setLevel(self, level):
+        self.level = level
+
+    def write(self, txt):
+        # Called by logging.flush() with text formatted by PsychoPy
+        self.sink._put((self, None, None, txt))
+
+
+class log_sink:
+    """Background writer for the session log files."""
+
+    def __init__(self, clock, maxsize=8192, batch_size=256, max_latency=0.2, fsync='batch', fsync_interval=1.0,
+                 log_format="{:.4f} \t{} \t{}\n"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        self.clock = clock
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.log_format = log_format
+        self.files = []
+        self.loggers = []
+        self.stalls = 0  # records that had to wait for a full queue
+        self.batches = 0
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        self._last_sync = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_file(self, path, level, filemode='w', logger=None):
+        # logger: PsychoPy logger (eg logging.root) to register the file with
+        target = log_file(self, path, level, filemode)
+        self.files.append(target)
+        if logger is not None:
+            logger.addTarget(target)
+            if logger not in self.loggers:
+                self.loggers.append(logger)
+        return target
+
+    def log(self, msg, level, t=None):
+        # Queue a record, t defaults to the current time of the sink clock
+        self._put((None, self.clock() if t is None else t, level, msg))
+
+    def console(self, txt):
+        # Queue a line for the console, timestamped with the wall clock now
+        if self._closed:
+            print('> {} {}'.format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), txt))
+        else:
+            self._put((None, time.time(), None, txt))
+
+    def flush(self, timeout=None):
+        # Block until everything queued so far is written
+        barrier = threading.Event()
+        self._put((None, None, None, barrier))
+        return barrier.wait(timeout)
+
+    def close(self, timeout=5.0):
+        if self._closed:
+            return
+        # hand the pending PsychoPy messages to the files, main thread only
+        for logger in self.loggers:
+            logger.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        for target in self.files:
+            for logger in self.loggers:
+                logger.removeTarget(target)
+            target.handle.close()
+
+    def _put(self, record):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # never drop records, wait for the writer instead
+            self.stalls += 1
+            self._queue.put(record)
+
+    def _format(self, record):
+        target, t, level, msg = record
+        if target is not None:
+            return [(target, msg)]
+        if level is None:
+            print('> {} {}'.format(datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"), msg))
+            return []
+        line = self.log_format.format(t, logging.getLevel(level), msg)
+        return [(f, line) for f in self.files if level >= f.level]
+
+    def _run(self):
+        stop = False
+        while not stop:
+            record = self._queue.get()
+            batch = [record]
+            t_end = time.perf_counter() + self.max_latency
+            while len(batch) < self.batch_size:
+                timeout = t_end - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if batch[-1] is None:
+                    break  # closing
+                if isinstance(batch[-1][3], threading.Event):
+                    break  # a flush is waiting
+
+            lines = {}
+            barriers = []
+            for record in batch:
+                if record is None:
+                    stop = True
+                elif isinstance(record[3], threading.Event):
+                    barriers.append(record[3])
+                else:
+                    for target, line in self._format(record):
+                        lines.setdefault(target, []).append(line)
+            self._write(lines, force_sync=stop or len(barriers) > 0)
+            for barrier in barriers:
+                barrier.set()
+
+    def _write(self, lines, force_sync=False):
+        now = time.perf_counter()
+        sync = self.fsync != 'none' and (
+            force_sync or self.fsync == 'batch' or now - self._last_sync >= self.fsync_interval)
+        for target, txt in lines.items():
+            try:
+                target.handle.write(''.join(txt))
+                target.handle.flush()
+                if sync:
+                    os.fsync(target.handle.fileno())
+            except (OSError, ValueError) as ex:
+                print('> LOGGING ERROR: {}: {}'.format(target.path, ex))
+        if sync:
+            self._last_sync = now
+        self.batches += 1
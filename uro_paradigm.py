@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compile an URO paradigm into a NumPy structured array.
+A paradigm is written as a list of rows
+    [event, command, duration, info(, rate(, axis))]
+with the duration in seconds and the rate in ml/min. axis is the Zaber
+device number that executes the entry (default 1, 0 for all axes at once).
+The compiler converts
+the whole paradigm in one vectorized pass into absolute onsets, durations,
+command codes, distances and device velocities, and validates the result
+against the resolution of the Zaber device.
+Paradigms can also be read from CSV or JSON Lines files, compiled paradigms
+are cached on disk.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import csv
+import hashlib
+import json
+import os
+import pathlib as pl
+
+import numpy as np
+
+# Command codes, the index in COMMANDS is the code stored in the array
+COMMANDS = ('rest', 'pause', 'infuse', 'withdraw')
+CMD_REST = 0
+CMD_PAUSE = 1
+CMD_INFUSE = 2
+CMD_WITHDRAW = 3
+CMD_INVALID = 255
+
+# Binary protocol limits
+MAX_RELATIVE_MOVE = 16777215  # microsteps
+VELOCITY_DATA_UNIT = 9.375  # microsteps/s per unit of target speed data
+AXIS_ALL = 0  # device 0 addresses all axes
+DEFAULT_AXIS = 1
+
+
+def paradigm_dtype(event_len=16, info_len=64):
+    return np.dtype([('event', 'U{}'.format(event_len)),
+                     ('command', 'u1'),
+                     ('info', 'U{}'.format(info_len)),
+                     ('onset', 'f8'),  # s, relative to the first entry
+                     ('duration', 'f8'),  # s
+                     ('rate', 'f8'),  # ml/min
+                     ('mm', 'f8'),  # signed distance
+                     ('microsteps', 'i8'),  # signed distance
+                     ('velocity', 'i8'),  # target speed data
+                     ('axis', 'u1'),  # device number, 0 for all axes
+                     ])
+
+
+def is_movement(command):
+    # Works on a single code as well as on an array of codes
+    return (command == CMD_INFUSE) | (command == CMD_WITHDRAW)
+
+
+def _per_axis(value, axis):
+    # Scalar or {axis: value} to one value per entry, nan for unknown axes;
+    # all axes (0) need the same value on every axis
+    if not isinstance(value, dict):
+        return np.full(len(axis), value, 'f8')
+    lookup = np.full(max(list(value) + [AXIS_ALL]) + 1, np.nan)
+    for a, v in value.items():
+        lookup[a] = v
+    values = set(value.values())
+    lookup[AXIS_ALL] = values.pop() if len(values) == 1 else np.nan
+    out = np.full(len(axis), np.nan)
+    known = axis < len(lookup)
+    out[known] = lookup[axis[known]]
+    return out
+
+
+def compile_paradigm(paradigm, microstep_size=None, max_velocity=None, max_relative_move=MAX_RELATIVE_MOVE):
+    """Compile a list of paradigm rows into a structured array.
+
+    microstep_size is the device microstep size in µm; without a device
+    (emulation) the microsteps and velocities are left at 0. max_velocity is
+    the highest allowed target speed in device data units. Both can be given
+    per axis as a dict keyed by device number, entries on other axes are then
+    rejected.
+    Raises ValueError listing every entry that fails validation.
+    """
+    n = len(paradigm)
+    events = [row[0] for row in paradigm]
+    infos = [row[3] for row in paradigm]
+    lookup = {name: code for code, name in enumerate(COMMANDS)}
+
+    compiled = np.zeros(n, dtype=paradigm_dtype(max([len(x) for x in events] + [1]),
+                                                max([len(x) for x in infos] + [1])))
+    compiled['event'] = events
+    compiled['info'] = infos
+    compiled['command'] = np.fromiter((lookup.get(row[1], CMD_INVALID) for row in paradigm), 'u1', n)
+    compiled['duration'] = np.fromiter((row[2] for row in paradigm), 'f8', n)
+    compiled['rate'] = np.fromiter((row[4] if len(row) > 4 else 0 for row in paradigm), 'f8', n)
+    compiled['axis'] = np.fromiter((row[5] if len(row) > 5 else DEFAULT_AXIS for row in paradigm), 'u1', n)
+
+    duration = compiled['duration']
+    command = compiled['command']
+    rate = compiled['rate']
+    move = is_movement(command)
+
+    compiled['onset'][1:] = np.cumsum(duration)[:-1]
+
+    # infuse moves forward, withdraw backward
+    sign = np.where(command == CMD_WITHDRAW, -1, 1) * move
+    compiled['mm'] = sign * np.abs(duration * rate / 60)
+
+    if microstep_size is not None:
+        # same rounding as zaber_tools.dist_mm_to_mustep and vel_mm_per_s_to_vel
+        size = _per_axis(microstep_size, compiled['axis'])
+        known = ~np.isnan(size)
+        size = np.where(known, size, 1.)
+        compiled['microsteps'] = known * sign * np.abs(np.rint(compiled['mm'] * 1000. / size))
+        compiled['velocity'] = known * move * np.ceil(np.rint(rate / 60 * 1000. / size) / VELOCITY_DATA_UNIT)
+
+    validate_paradigm(compiled, microstep_size, max_velocity, max_relative_move)
+    return compiled
+
+
+def validate_paradigm(compiled, microstep_size=None, max_velocity=None, max_relative_move=MAX_RELATIVE_MOVE):
+    command = compiled['command']
+    move = is_movement(command)
+
+    checks = [(command == CMD_INVALID, 'unknown command'),
+              (~(compiled['duration'] >= 0), 'invalid duration'),
+              (move & ~(compiled['rate'] > 0), 'rate must be positive')]
+
+    if microstep_size is not None:
+        microsteps = np.abs(compiled['microsteps'])
+        velocity = compiled['velocity']
+        known = ~np.isnan(_per_axis(microstep_size, compiled['axis']))
+        resolution = '' if isinstance(microstep_size, dict) else ' of {:.4f} µm'.format(microstep_size)
+        checks += [(~known, 'unknown axis, or the axes differ in resolution'),
+                   (known & move & (compiled['rate'] > 0) & (microsteps == 0),
+                    'volume below the device resolution' + resolution),
+                   (move & (microsteps > max_relative_move),
+                    'distance exceeds the maximum relative move of {} microsteps'.format(max_relative_move)),
+                   (known & move & (compiled['rate'] > 0) & (velocity < 1),
+                    'rate below the device velocity resolution')]
+        if max_velocity is not None:
+            checks.append((move & (velocity > _per_axis(max_velocity, compiled['axis'])),
+                           'velocity exceeds the maximum of the axis'))
+
+    errors = []
+    for failed, msg in checks:
+        for idx in np.flatnonzero(failed):
+            errors.append('entry {} ({}, {}): {}'.format(idx, compiled['event'][idx], compiled['info'][idx].replace('\n', ' '), msg))
+
+    if len(errors) > 0:
+        raise ValueError('Invalid paradigm:\n' + '\n'.join(errors))
+
+
+def command_name(code):
+    return COMMANDS[code] if code < len(COMMANDS) else 'unknown'
+
+
+# ######################################################################
+# PARADIGM FILES
+# ######################################################################
+# Bump when the compiled layout or the conversions change
+CACHE_VERSION = 3
+CACHE_DIR = './paradigm-cache'
+# Required keys of a JSONL paradigm line, in row order
+JSONL_KEYS = ('event', 'command', 'duration', 'info')
+
+
+def read_paradigm(path):
+    """Parse a paradigm file row by row.
+
+    Supported formats:
+    - .csv: event, command, duration, info(, rate(, axis)), '\\n' in info is
+      a newline
+    - .jsonl: one object per line with the keys event, command, duration,
+      info and optionally rate and axis
+    Empty lines and lines starting with # are skipped.
+    """
+    suffix = pl.Path(path).suffix.lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if suffix == '.csv':
+            lines = (line for line in f if line.strip() and not line.lstrip().startswith('#'))
+            for rownr, row in enumerate(csv.reader(lines, delimiter=','), 1):
+                row = [x.strip(' ').replace('\\n', '\n') for x in row]
+                yield _parse_row(row, path, rownr)
+        elif suffix in ('.jsonl', '.ndjson'):
+            for lineno, line in enumerate(f, 1):
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError as ex:
+                    raise ValueError('{}, row {}: invalid JSON: {}'.format(path, lineno, ex))
+                if not isinstance(obj, dict):
+                    raise ValueError('{}, row {}: expected an object, got {}'.format(path, lineno, line.strip()))
+                missing = [key for key in JSONL_KEYS if key not in obj]
+                if missing:
+                    raise ValueError('{}, row {}: missing {}'.format(path, lineno, ', '.join(missing)))
+                row = [obj[key] for key in JSONL_KEYS]
+                if obj.get('rate') is not None or obj.get('axis') is not None:
+                    row.append(obj.get('rate') or 0)
+                if obj.get('axis') is not None:
+                    row.append(obj['axis'])
+                yield _parse_row(row, path, lineno)
+        else:
+            raise ValueError('Unsupported paradigm file format: {}'.format(path))
+
+
+def _parse_row(row, path, rownr):
+    if len(row) > 5 and row[5] == '':
+        row = row[:5]
+    if len(row) > 4 and row[4] == '':
+        row[4] = 0
+    try:
+        if len(row) < 4:
+            raise ValueError
+        row[2] = float(row[2])
+        if len(row) > 4:
+            row[4] = float(row[4])
+        if len(row) > 5:
+            row[5] = int(row[5])
+            if not 0 <= row[5] <= 255:
+                raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError('{}, row {}: invalid paradigm row {}'.format(path, rownr, row))
+    return row[:6]
+
+
+def file_hash(path, chunk_size=1 << 16):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def device_hash(microstep_size=None, microstep_resolution=None, max_velocity=None):
+    # Short hash of the device inputs of compile_paradigm, 'emulation' without a device
+    if microstep_size is None:
+        return 'emulation'
+
+    def canonical(value):
+        if isinstance(value, dict):
+            return [[int(k), repr(float(v))] for k, v in sorted(value.items())]
+        return None if value is None else repr(float(value))
+
+    inputs = [canonical(microstep_size), canonical(microstep_resolution), canonical(max_velocity),
+              MAX_RELATIVE_MOVE, VELOCITY_DATA_UNIT]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:16]
+
+
+def load_paradigm(path, microstep_size=None, microstep_resolution=None, max_velocity=None, cache_dir=CACHE_DIR):
+    """Load and compile a paradigm file through the on-disk cache.
+
+    The cache is keyed by the file hash and a hash of every device input of
+    the conversion and the validation: the microstep size (which follows
+    from the mechanics of the axis), the microstep resolution and the maximum
+    velocity, each a value or a dict keyed by device number. A hit skips
+    parsing, conversion and validation.
+    Returns the compiled paradigm and whether the cache was hit.
+    """
+    key = '{}_dev-{}_v{}.npy'.format(file_hash(path), device_hash(microstep_size, microstep_resolution, max_velocity),
+                                     CACHE_VERSION)
+    cache_file = pl.Path(cache_dir, key)
+
+    if cache_file.exists():
+        try:
+            return np.load(str(cache_file), allow_pickle=False), True
+        except (OSError, ValueError):
+            pass  # corrupt entry, compile again
+
+    compiled = compile_paradigm(list(read_paradigm(path)), microstep_size, max_velocity)
+
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        with open(str(tmp_file), 'wb') as f:
+            np.save(f, compiled, allow_pickle=False)
+        os.replace(str(tmp_file), str(cache_file))
+    except OSError:
+        pass  # the cache is an optimisation only
+    return compiled, False
+
+
+# ######################################################################
+# SCHEDULER
+# ######################################################################
+class paradigm_scheduler:
+    """Absolute schedule of a compiled paradigm.
+
+    Every onset is computed from the scanner trigger t0, never accumulated.
+    An entry that starts after its onset (because the previous one overran)
+    is handled according to the policy:
+    - 'catchup': a late infuse or withdraw keeps its full duration, which
+      shifts the schedule; the following rest and pause entries are
+      shortened (down to zero time) until the schedule is back on the grid
+    - 'shorten': the late entry is shortened by its lateness so that it ends
+      at its nominal end, when it is fully overrun it is presented for zero
+      time; later onsets never move
+    - 'abort': lateness beyond tolerance ends the session
+    Lateness within tolerance is always absorbed by the late entry.
+    """
+    POLICIES = ('catchup', 'shorten', 'abort')
+
+    def __init__(self, compiled, t0, policy='catchup', tolerance=0.1):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown overrun policy: {}'.format(policy))
+        n = len(compiled)
+        self.policy = policy
+        self.tolerance = tolerance
+        self.t0 = t0
+        self.events = compiled['event']
+        self.onsets = t0 + compiled['onset']  # nominal absolute onsets
+        self.durations = compiled['duration']
+        self.movements = is_movement(compiled['command'])
+        self.shift = 0.0  # largest shift of an end time from the grid (catchup)
+        self.start = np.full(n, np.nan)  # scheduled start after the policy
+        self.end = np.full(n, np.nan)  # scheduled end after the policy
+        self.actual_start = np.full(n, np.nan)
+        self.actual_end = np.full(n, np.nan)
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def slot(self, idx, now):
+        """Scheduled start and end time of entry idx when it starts at now.
+
+        Returns None when the abort policy rejects the entry.
+        """
+        start = self.onsets[idx]
+        end = start + self.durations[idx]
+        late = now - start
+
+        if late > self.tolerance and self.policy == 'abort':
+            self.actual_start[idx] = now
+            return None
+        if late > self.tolerance and self.policy == 'catchup' and self.movements[idx]:
+            end = now + self.durations[idx]
+            self.shift = max(self.shift, end - (start + self.durations[idx]))
+
+        self.start[idx] = start
+        self.end[idx] = max(end, now)
+        self.actual_start[idx] = now
+        return start, self.end[idx]
+
+    def finished(self, idx, now):
+        # Returns the overrun of entry idx beyond its scheduled end
+        self.actual_end[idx] = now
+        return now - self.end[idx]
+
+    def lateness(self):
+        # Actual onset relative to the nominal onset from the trigger
+        return self.actual_start - self.onsets
+
+    def overruns(self):
+        return self.actual_end - self.end
+
+    def summary(self):
+        done = ~np.isnan(self.actual_start)
+        late = self.lateness()[done]
+        if len(late) == 0:
+            return {'entries': 0}
+        return {'entries': int(done.sum()),
+                'policy': self.policy,
+                'mean': float(np.mean(late)),
+                'p95': float(np.percentile(late, 95)),
+                'max': float(np.max(late)),
+                'late': int(np.sum(late > self.tolerance)),
+                'worst': str(self.events[done][np.argmax(late)]),
+                'shift': self.shift}
+
+    def report(self):
+        # Per event lateness lines followed by the summary line
+        lines = []
+        late = self.lateness()
+        overrun = self.overruns()
+        for idx in np.flatnonzero(~np.isnan(self.actual_start)):
+            lines.append('{}, {}, onset {:.3f}, actual {:.3f}, lateness {:.4f}, overrun {:.4f}'.format(
+                idx, self.events[idx], self.onsets[idx], self.actual_start[idx], late[idx], overrun[idx]))
+        s = self.summary()
+        if s['entries'] > 0:
+            lines.append('Schedule ({}): {} entries, lateness mean {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms ({}), '
+                         '{} entries later than {:.0f} ms, max schedule shift {:.3f} s'.format(
+                             s['policy'], s['entries'], s['mean']*1000, s['p95']*1000, s['max']*1000, s['worst'],
+                             s['late'], self.tolerance*1000, s['shift']))
+        return lines
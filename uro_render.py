@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Rendering helpers for the URO dashboards.
+layered_dashboard draws the static part of a dashboard (boxes, headers,
+title) once into a BufferImageStim and per frame only draws that texture and
+the stimuli that change. The cached layer is rebuilt when it is invalidated,
+eg when a header changes through set_text(). The number of draw calls and
+the CPU time per frame are counted, the GPU time is measured with OpenGL
+timer queries when gpu_timing is set, so both modes can be compared
+(cache=False draws every stimulus every frame).
+number_sprites lays out the values of a countdown once, so the countdown
+swaps stimuli instead of laying out text every second.
+warm_up() draws the display states of a session offscreen before it starts,
+so shader compilation, glyph rendering and texture uploads do not land on
+the first frames of the paradigm.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import ctypes
+import time
+
+import numpy as np
+from psychopy import visual
+
+
+class gpu_timer:
+    """GPU time of the draws between begin() and end().
+
+    Uses OpenGL timer queries (OpenGL 3.3 or ARB_timer_query); the result of
+    a frame is read at the end of the next frame so reading does not stall the
+    pipeline. available is False when the queries are not supported.
+    """
+
+    def __init__(self):
+        self.samples = []  # s per frame
+        self.available = False
+        self._frame = 0
+        self._pending = None
+        try:
+            from pyglet import gl
+            ids = (gl.GLuint * 2)()
+            gl.glGenQueries(2, ids)
+            self._gl = gl
+            self._ids = list(ids)
+            self.available = True
+        except Exception:
+            pass
+
+    def begin(self):
+        if self.available:
+            self._gl.glBeginQuery(self._gl.GL_TIME_ELAPSED, self._ids[self._frame % 2])
+
+    def end(self):
+        if not self.available:
+            return
+        gl = self._gl
+        try:
+            gl.glEndQuery(gl.GL_TIME_ELAPSED)
+            if self._pending is not None:
+                result = gl.GLuint64()
+                gl.glGetQueryObjectui64v(self._pending, gl.GL_QUERY_RESULT, ctypes.byref(result))
+                self.samples.append(result.value * 1e-9)
+        except Exception:
+            self.available = False
+            return
+        self._pending = self._ids[self._frame % 2]
+        self._frame += 1
+
+
+class layered_dashboard:
+    """Dashboard drawn as a cached static layer plus the dynamic stimuli.
+
+    static and dynamic are lists of stimuli in drawing order, the static
+    layer is drawn below the dynamic stimuli. Building the layer clears the
+    back buffer, so draw() must be the first drawing of a frame.
+    visual_module: module with BufferImageStim, psychopy.visual by default
+    """
+
+    def __init__(self, win, static, dynamic, cache=True, gpu_timing=False, visual_module=None):
+        self.win = win
+        self.static = list(static)
+        self.dynamic = list(dynamic)
+        self.cache = cache
+        self.visual = visual if visual_module is None else visual_module
+        self.gpu = gpu_timer() if gpu_timing else None
+        self.frames = 0
+        self.draw_calls = 0
+        self.cache_builds = 0
+        self.draw_times = []  # CPU time per frame, s
+        self._static_ids = {id(stim) for stim in self.static}
+        self._layer = None
+
+    def set_text(self, stim, text):
+        # Change the text of a stimulus, returns whether it changed;
+        # a static stimulus invalidates the cached layer
+        if stim.text == text:
+            return False
+        stim.text = text
+        if id(stim) in self._static_ids:
+            self.invalidate()
+        return True
+
+    def invalidate(self):
+        # Rebuild the static layer on the next draw, eg after a layout change
+        self._layer = None
+
+    def draw(self):
+        t0 = time.perf_counter()
+        if self.gpu is not None:
+            self.gpu.begin()
+        if self.cache:
+            if self._layer is None:
+                self._build()
+            self._layer.draw()
+            calls = 1
+        else:
+            for stim in self.static:
+                stim.draw()
+            calls = len(self.static)
+        for stim in self.dynamic:
+            stim.draw()
+        if self.gpu is not None:
+            self.gpu.end()
+        self.draw_times.append(time.perf_counter() - t0)
+        self.draw_calls += calls + len(self.dynamic)
+        self.frames += 1
+
+    def _build(self):
+        # BufferImageStim draws the stimuli in the back buffer, captures and clears it
+        self._layer = self.visual.BufferImageStim(self.win, stim=self.static)
+        self.cache_builds += 1
+
+    def report(self):
+        # One line with the draw statistics
+        if self.frames == 0:
+            return 'Dashboard: no frames drawn'
+        txt = 'Dashboard ({}): {} frames, {:.1f} draw calls per frame ({} without the cache), CPU {:.3f} ms'.format(
+            'cached' if self.cache else 'not cached', self.frames, self.draw_calls / self.frames,
+            len(self.static) + len(self.dynamic), np.mean(self.draw_times) * 1000)
+        if self.gpu is not None and self.gpu.samples:
+            txt += ', GPU {:.3f} ms'.format(np.mean(self.gpu.samples) * 1000)
+        if self.cache:
+            txt += ', {} layer builds'.format(self.cache_builds)
+        return txt
+
+
+class number_sprites:
+    """Countdown numbers laid out once, drawn without text layout.
+
+    prepare() creates a TextStim per value from 0 to max_value with the
+    attributes of the template and draws it once, so its glyphs are rendered
+    before the session. set_value() then swaps the stimulus in O(1); values
+    outside the cache fall back to assigning the text of the template.
+    The object is drawn like a stimulus, eg as a dynamic stimulus of a
+    layered_dashboard.
+    """
+
+    ATTRIBUTES = ('pos', 'height', 'alignText', 'wrapWidth', 'color', 'colorSpace', 'font', 'units', 'opacity')
+
+    def __init__(self, template, visual_module=None):
+        self.template = template
+        self.visual = visual if visual_module is None else visual_module
+        self.sprites = []
+        self.current = template
+        self.misses = 0  # values drawn as text
+        self.warmup_time = 0.0
+        self._value = None
+
+    def prepare(self, max_value):
+        # Lay out and draw the values 0..max_value, returns the time it took
+        t0 = time.perf_counter()
+        win = self.template.win
+        attributes = {name: getattr(self.template, name) for name in self.ATTRIBUTES
+                      if hasattr(self.template, name)}
+        self.sprites = []
+        for value in range(max_value + 1):
+            sprite = self.visual.TextStim(win=win, text=str(value), **attributes)
+            sprite.draw()
+            self.sprites.append(sprite)
+        win.clearBuffer()
+        self._value = None
+        self.warmup_time = time.perf_counter() - t0
+        return self.warmup_time
+
+    def set_value(self, value):
+        # Show value, returns whether it changed
+        if value == self._value:
+            return False
+        self._value = value
+        if 0 <= value < len(self.sprites):
+            self.current = self.sprites[value]
+        else:
+            self.misses += 1
+            self.template.text = str(value)
+            self.current = self.template
+        return True
+
+    def draw(self, win=None):
+        self.current.draw()
+
+
+def finish():
+    # Wait until the GPU executed the queued drawing, a no-op without OpenGL
+    try:
+        from pyglet import gl
+        gl.glFinish()
+    except Exception:
+        pass
+
+
+def warm_up(win, states, draw, passes=2):
+    """Draw display states offscreen and time them.
+
+    states: functions that each set up a state of the display (texts,
+    colours), draw: draws a frame. Every state is drawn into the back buffer,
+    finished on the GPU and cleared, nothing is flipped. A time covers the
+    set-up and the drawing, as the first frame of a condition does; the first
+    pass pays the one-off costs, the next passes show the time of a warm frame.
+    Returns the times (s) as an array of shape (passes, states).
+    """
+    times = np.zeros((passes, len(states)))
+    for i in range(passes):
+        for j, state in enumerate(states):
+            t0 = time.perf_counter()
+            state()
+            draw()
+            finish()
+            times[i, j] = time.perf_counter() - t0
+            win.clearBuffer()
+    return times
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Pre-flight self-test of a URO session.
+Measures, before the scanner trigger, what the paradigm timing depends on:
+- the Zaber round-trip latency of position queries
+- the frame intervals of a burst of flips
+- the time a keyboard poll takes
+and checks the results against thresholds. A check is a tuple
+(name, value, limit, passed); values and limits are in ms, except the count
+of dropped frames.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import time
+
+import numpy as np
+from zaber_motion.binary import CommandCode
+
+DEFAULT_THRESHOLDS = {'zaber_p99_ms': 50.0,  # position query round-trip
+                      'frame_p99_ms': 25.0,  # interval between flips
+                      'frames_dropped': 1,  # intervals longer than 1.5 frame periods
+                      'key_poll_p99_ms': 2.0,  # duration of a keyboard poll
+                      }
+
+
+def zaber_round_trips(zt, n=20):
+    # Round-trip times (s) of position queries, spread over the axes
+    devices = sorted(zt.devices)
+    latencies = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        zt.command(devices[i % len(devices)], CommandCode.RETURN_CURRENT_POSITION)
+        latencies.append(time.perf_counter() - t0)
+    return np.array(latencies)
+
+
+def frame_intervals(win, n=120, draw=None):
+    # Intervals (s) between n flips, draw() is called before every flip
+    stamps = np.empty(n + 1)
+    if draw is not None:
+        draw()
+    win.flip()
+    stamps[0] = time.perf_counter()
+    for i in range(1, n + 1):
+        if draw is not None:
+            draw()
+        win.flip()
+        stamps[i] = time.perf_counter()
+    return np.diff(stamps)
+
+
+def dropped_frames(intervals, frame_period=None):
+    # Intervals longer than 1.5 frame periods, the period defaults to the median interval
+    if len(intervals) == 0:
+        return 0
+    if frame_period is None:
+        frame_period = float(np.median(intervals))
+    return int(np.sum(intervals > 1.5 * frame_period))
+
+
+def poll_durations(poll, n=200):
+    # Duration (s) of n calls of poll
+    durations = np.empty(n)
+    for i in range(n):
+        t0 = time.perf_counter()
+        poll()
+        durations[i] = time.perf_counter() - t0
+    return durations
+
+
+def p99_ms(samples):
+    return float(np.percentile(samples, 99)) * 1000
+
+
+def run_self_test(win, zt=None, poll=None, draw=None, thresholds=None, frame_period=None,
+                  n_frames=120, n_zaber=20, n_polls=200):
+    """Run the measurements and return the checks.
+
+    zt: zaber_tools object, None skips the Zaber check
+    poll: keyboard poll, eg lambda: event.getKeys(keyList=['escape'])
+    thresholds: overrides of DEFAULT_THRESHOLDS
+    frame_period: nominal frame period (s) to count dropped frames, by
+        default the period of the window or the median interval
+    """
+    limits = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    checks = []
+    if zt is not None:
+        checks.append(('Zaber round-trip p99', p99_ms(zaber_round_trips(zt, n_zaber)), limits['zaber_p99_ms']))
+    intervals = frame_intervals(win, n_frames, draw)
+    if frame_period is None:
+        frame_period = getattr(win, 'monitorFramePeriod', None)  # nominal period of a PsychoPy window
+    checks.append(('Frame interval p99', p99_ms(intervals), limits['frame_p99_ms']))
+    checks.append(('Dropped frames', dropped_frames(intervals, frame_period), limits['frames_dropped']))
+    if poll is not None:
+        checks.append(('Key poll p99', p99_ms(poll_durations(poll, n_polls)), limits['key_poll_p99_ms']))
+    return [(name, value, limit, value <= limit) for name, value, limit in checks]
+
+
+def report(checks):
+    # One line per check
+    lines = []
+    for name, value, limit, passed in checks:
+        unit = '' if isinstance(value, int) else ' ms'
+        fmt = '{}: {}{} (limit {}{}) {}' if unit == '' else '{}: {:.1f}{} (limit {:g}{}) {}'
+        lines.append(fmt.format(name, value, unit, limit, unit, 'ok' if passed else 'OUT OF SPEC'))
+    return lines
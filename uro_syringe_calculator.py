@@ -10,6 +10,7 @@ Some stuff is hard-coded, with some effort it can be parameterized.
 
 from psychopy import core, clock, visual, event, gui, logging
 import numpy as np
+import uro_render
 
 # ######################################################################
 # HELPER FUNCTIONS
@@ -251,6 +252,14 @@ txt_copyr = visual.TextStim(
     pos=txt_copyr_pos,
     height=0.05, alignText='left', text="(C) 2021 Pieter Vandemaele", wrapWidth=txt_copyr_wrap)
 
+# ## LAYERS
+# static chrome drawn once into a cached layer, see uro_render
+dashboard = uro_render.layered_dashboard(
+    win,
+    static=[rect_titleBox, txt_titleBox, txt_copyr, rect_syr1Box, rect_syr1Hdr, txt_syr1Hdr,
+            rect_syr2Box, rect_syr2Hdr, txt_syr2Hdr, rect_contBox],
+    dynamic=[txt_syr1Box, txt_syr2Box, txt_contBox])
+
 # ######################################################################
 # OTHER GRAPHICAL COMPONENTS
 # ######################################################################
@@ -271,27 +280,16 @@ def draw_hdr_ftr():
 
 
 def draw_dashboard():
-    draw_hdr_ftr()
-
-    rect_syr1Box.draw()
-    rect_syr1Hdr.draw()
-    txt_syr1Hdr.draw()
-    txt_syr1Box.draw()
-
-    rect_syr2Box.draw()
-    rect_syr2Hdr.draw()
-    txt_syr2Hdr.draw()
-    txt_syr2Box.draw()
-
-    rect_contBox.draw()
-    txt_contBox.draw()
+    # cached boxes, title and headers, then the syringe and button text
+    dashboard.draw()
 
 
 def present_text(info=['', ''], cont='', quit=True, wait=True, col='white', title=['', '']):
     txt_syr1Box.text = info[0]
-    txt_syr1Hdr.text = title[0]
     txt_syr2Box.text = info[1]
-    txt_syr2Hdr.text = title[1]
+    # a header change rebuilds the cached layer
+    dashboard.set_text(txt_syr1Hdr, title[0])
+    dashboard.set_text(txt_syr2Hdr, title[1])
     txt_contBox.text = cont
 
     draw_dashboard()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Frame timing of a URO session.
+frame_log keeps the timestamp of every frame of the countdown loop in a
+preallocated array, tagged with the index of the paradigm entry on screen and
+whether the frame was flipped or skipped because nothing changed. At the end
+of the session save() writes the frames to a .npy file (13 bytes per frame)
+and report() summarises the frame intervals per paradigm entry, so missed
+frames can be matched to the onsets of the movements. The first interval of
+an entry spans the start of the entry (logging, the move command) and is
+reported separately as the onset interval.
+predict_flip() predicts the time of the flip closest to an onset from the
+last flip and the frame period, to show a condition on the frame nearest its
+scheduled start.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+from math import floor
+
+import numpy as np
+
+import uro_paradigm
+import uro_selftest
+
+FRAME_DTYPE = np.dtype([('t', 'f8'), ('entry', 'i4'), ('flipped', 'u1')])
+
+
+class frame_log:
+    """Preallocated record of frame timestamps."""
+
+    def __init__(self, capacity, frame_period=1. / 60):
+        # frame_period: nominal period (s), intervals over 1.5 periods count as dropped frames
+        self.capacity = capacity
+        self.frame_period = frame_period
+        self.count = 0
+        self.overflow = 0  # frames that did not fit
+        self.last_flip = None  # time of the last flipped frame
+        self._t = np.zeros(capacity, 'f8')
+        self._entry = np.zeros(capacity, 'i4')
+        self._flipped = np.zeros(capacity, 'u1')
+
+    def record(self, t, entry, flipped=True):
+        # Called once per frame, does not allocate
+        if flipped:
+            self.last_flip = t
+        if self.count >= self.capacity:
+            self.overflow += 1
+            return
+        self._t[self.count] = t
+        self._entry[self.count] = entry
+        self._flipped[self.count] = flipped
+        self.count += 1
+
+    def frames(self):
+        # Recorded frames as a FRAME_DTYPE array (a copy)
+        frames = np.empty(self.count, FRAME_DTYPE)
+        frames['t'] = self._t[:self.count]
+        frames['entry'] = self._entry[:self.count]
+        frames['flipped'] = self._flipped[:self.count]
+        return frames
+
+    def save(self, path):
+        np.save(str(path), self.frames())
+
+    def summary(self):
+        """Frame statistics per paradigm entry.
+
+        Returns a list of (entry, frames, flips, mean interval, p99 interval,
+        dropped frames, onset interval), intervals in s; an interval belongs to
+        the entry of the frame that ends it.
+        """
+        t = self._t[:self.count]
+        entry = self._entry[:self.count]
+        flipped = self._flipped[:self.count]
+        if self.count < 2:
+            return []
+        intervals = np.diff(t)
+        owner = entry[1:]
+        onset = owner != entry[:-1]  # first interval of an entry
+        rows = []
+        for idx in np.unique(owner):
+            mine = owner == idx
+            steady = intervals[mine & ~onset]
+            first = intervals[mine & onset]
+            rows.append((int(idx), int(np.sum(entry == idx)), int(np.sum(flipped[entry == idx])),
+                         float(np.mean(steady)) if len(steady) else np.nan,
+                         float(np.percentile(steady, 99)) if len(steady) else np.nan,
+                         uro_selftest.dropped_frames(intervals[mine], self.frame_period),
+                         float(first[0]) if len(first) else np.nan))
+        return rows
+
+    def report(self, paradigm=None):
+        # Lines per entry and a last line for the whole session, in ms
+        lines = []
+        rows = self.summary()
+        for idx, n, flips, mean, p99, dropped, onset in rows:
+            name = ''
+            if paradigm is not None and 0 <= idx < len(paradigm):
+                name = '{}, {}, '.format(paradigm[idx]['event'],
+                                         uro_paradigm.command_name(paradigm[idx]['command']))
+            lines.append('{}, {}frames {} ({} flipped), mean {:.2f} ms, p99 {:.2f} ms, dropped {}, '
+                         'onset interval {:.2f} ms'.format(idx, name, n, flips, mean * 1000, p99 * 1000, dropped,
+                                                           onset * 1000))
+        intervals = np.diff(self._t[:self.count])
+        if len(intervals) > 0:
+            lines.append('Frames: {} recorded ({} flipped){}, mean interval {:.2f} ms, p99 {:.2f} ms, '
+                         'sd {:.2f} ms, {} dropped'.format(
+                             self.count, int(np.sum(self._flipped[:self.count])),
+                             ', {} over capacity'.format(self.overflow) if self.overflow else '',
+                             np.mean(intervals) * 1000, np.percentile(intervals, 99) * 1000,
+                             np.std(intervals) * 1000, sum(row[5] for row in rows)))
+        return lines
+
+
+def predict_flip(last_flip, frame_period, now, target=None):
+    """Predicted time of the flip closest to target.
+
+    Flips are assumed on the refresh grid last_flip + k * frame_period, the
+    earliest is the first refresh after now. Without a previous flip
+    (last_flip None) the earliest flip is taken to be now. target None
+    returns the earliest flip.
+    """
+    if last_flip is None:
+        earliest = now
+    else:
+        earliest = last_flip + (floor(max(now - last_flip, 0.) / frame_period) + 1) * frame_period
+    if target is None or target <= earliest:
+        return earliest
+    return earliest + round((target - earliest) / frame_period) * frame_period
+
+
+def read_frames(path):
+    # Frames written by frame_log.save
+    return np.load(str(path))
@@ -4,6 +4,8 @@ from datetime import datetime
 from math import floor, ceil
 import numpy as np
 import zaber_tools
+import zaber_daemon
+import uro_render
 from zaber_motion.binary import CommandCode, BinarySettings
 from zaber_motion import Units, FirmwareVersion, Measurement, Tools
 # from zaber_motion import BinaryCommandFailedExceptionData
@@ -23,8 +25,9 @@ def print_log(txt):
 # SET PARAMETERS
 # ######################################################################
 
-comPort_Zaber = 'COM9'  # expInfo['COM Port (Zaber)']
+comPort_Zaber = 'auto'  # expInfo['COM Port (Zaber)'], auto: probe the serial ports
 target_speed = 10
+position_recheck = 60  # s, age after which the modelled position is checked against the device
 speed_factor = 2/3
 
 demo = False
@@ -212,6 +215,13 @@ txt_copyr = visual.TextStim(
     pos=txt_copyr_pos,
     height=0.05, alignText='left', text="(C) 2021 Pieter Vandemaele", wrapWidth=txt_copyr_wrap)
 
+# ## LAYERS
+# static chrome drawn once into a cached layer, see uro_render
+dashboard = uro_render.layered_dashboard(
+    win,
+    static=[rect_titleBox, txt_titleBox, txt_copyr, rect_infoBox, rect_infoHdr, txt_infoHdr, rect_contBox],
+    dynamic=[txt_infoBox, txt_contBox])
+
 # ######################################################################
 # OTHER GRAPHICAL COMPONENTS
 # ######################################################################
@@ -228,23 +238,26 @@ def zaber_connect(comPort):
     # OPEN A ZABER CONNECTION
     print_log('CONNECTING TO ZABER')
     try:
-        zt = zaber_tools.zaber_tools(comPort)
-        # device id
-        resp = zt.connection.generic_command(1, CommandCode.RETURN_SETTING,  50, timeout=0.0, check_errors=True)
-        print_log(' Connected to Zaber on {} | Device ID: {}'.format(comPort, resp.data))
+        # use the Zaber daemon when it is running, it keeps the port open
+        zt = zaber_tools.zaber_tools(zaber_daemon.zaber_port(comPort))
+        # device id, from the device snapshot after the first connection
+        device_id = zt.get_setting(1, 50)
+        print_log(' Connected to Zaber on {} | Device ID: {}'.format(comPort, device_id))
 
     except Exception as e:
         print_log("ZABER ERROR: {0}".format(e))
         core.quit()
 
-    return zt, resp.data
+    return zt, device_id
 
 
 def zaber_disconnect(zt):
     # DISCONNECT A ZABER CONNECTION
     print_log('DISCONNECT FROM ZABER')
     try:
-        zt.device.stop()
+        zt.stop()
+        print_log(' Settings cache saved {} round-trips, position model saved {}'.format(
+            zt.settings_saved(), zt.position_stats['saved']))
         zt.close()
     except Exception as e:
         pass
@@ -256,8 +269,8 @@ def zaber_get_limits(zt):
     min_pos = 0
     max_pos = 0
     try:
-        min_pos = zt.device.settings.get(BinarySettings.MINIMUM_POSITION, Units.NATIVE)
-        max_pos = zt.device.settings.get(BinarySettings.MAXIMUM_POSITION, Units.NATIVE)
+        min_pos = zt.get_setting(1, CommandCode.SET_MINIMUM_POSITION.value)
+        max_pos = zt.get_setting(1, CommandCode.SET_MAXIMUM_POSITION.value)
     except Exception as e:
         print_log("ZABER ERROR: {0}".format(e))
     return [min_pos, max_pos]
@@ -267,7 +280,9 @@ def zaber_set_target_speed(zt, target_speed):
     # SET TARGET SPEED
     print_log('SET TARGET SPEED')
     try:
-        zt.device.settings.set(BinarySettings.TARGET_SPEED, target_speed, Units.VELOCITY_MILLIMETRES_PER_SECOND)
+        # native units, the device is not identified when connected from the snapshot
+        # the settings cache skips the write when the speed is already set
+        zt.set_setting(1, BinarySettings.TARGET_SPEED, round(zt.vel_mm_per_s_to_vel(target_speed))).result()
     except Exception as e:
         print_log("ZABER ERROR: {0}".format(e))
 
@@ -276,7 +291,8 @@ def zaber_set_home(zt, home_pos):
     # SET HOME OFFSET TO MINIMUM POSITION AND HOME
     print_log('SET HOME OFFSET TO MINIMUM POSITION AND HOME')
     try:
-        zt.device.settings.set(BinarySettings.HOME_OFFSET, home_pos, Units.LENGTH_MILLIMETRES)
+        # home_pos is the minimum position in microsteps
+        zt.set_setting(1, BinarySettings.HOME_OFFSET, home_pos).result()
         zaber_move_abs(zt, home_pos, interrupt=False)
     except Exception as e:
         print_log("ZABER ERROR: {0}".format(e))
@@ -288,8 +304,8 @@ def zaber_move_abs(zt, position, interrupt=True):
     pressed = []
 
     try:
-        resp = zt.connection.generic_command(1, CommandCode.RETURN_CURRENT_POSITION)
-        cur_pos = resp.data
+        # local position model, updated from the move replies
+        cur_pos = zt.position(1, max_age=position_recheck)
     except Exception as e:
         print_log("ZABER ERROR: {0}".format(e))
         core.quit()
@@ -299,21 +315,22 @@ def zaber_move_abs(zt, position, interrupt=True):
     else:
         print_log('EXTENDING DEVICE')
 
-    try:
-        zt.connection.generic_command_no_response(1, CommandCode.MOVE_ABSOLUTE,  int(position))
+    def check_keys():
+        pressed[:] = event.getKeys(keyList=['escape', 'space'])
 
-        while zt.device.is_busy() and go:
-            pressed = event.getKeys(keyList=['escape', 'space'])
+        # filter out space pressed while interrupt is False
+        return len(pressed) == 0 or (not interrupt and 'space' in pressed)
 
-            if len(pressed) > 0:
-                # filter out space pressed while interrupt is False
-                if not (not interrupt and 'space' in pressed):
-                    go = False
+    try:
+        move = zt.move_absolute(int(position))
+        go = zt.wait_move(move, poll=check_keys)
 
-        if not go:
+        if go:
+            print_log('DEVICE MOVED IN {:.2f} s | {} SERIAL TRANSACTIONS'.format(move.duration(), move.transactions))
+        else:
             print_log('DEVICE MOTION INTERRUPTED BY USER')
             try:
-                zt.device.stop()
+                zt.stop()
             except Exception as e:
                 print_log("ZABER ERROR: {0}".format(e))
 
@@ -352,24 +369,13 @@ def draw_hdr_ftr():
 
 
 def draw_dashboard():
-    draw_hdr_ftr()
-#    rect_titleBox.draw()
-#    txt_titleBox.draw()
-
-    rect_infoBox.draw()
-    rect_infoHdr.draw()
-    txt_infoHdr.draw()
-    txt_infoBox.draw()
-
-    rect_contBox.draw()
-    txt_contBox.draw()
-
-#    txt_copyr.draw()
+    # cached boxes, title and header, then the info and button text
+    dashboard.draw()
 
 
 def present_text(info='', button='', quit=True, wait=True, col='white', check='', title=''):
     txt_infoBox.text = info
-    txt_infoHdr.text = title
+    dashboard.set_text(txt_infoHdr, title)  # rebuilds the cached layer on a change
     txt_contBox.text = button
 
     draw_dashboard()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local daemon that keeps the Zaber connection open for the URO tools.
+The daemon opens the serial port once, detects and identifies the devices,
+and serves clients over a Unix socket. Every client sees the port as its own:
+commands from all clients are serialized by the dispatcher of the daemon and
+the unsolicited replies of the devices (move completion) are forwarded to
+every client, so an operator can monitor the pump while the experiment runs.
+
+Clients use the normal zaber_tools class with a com_port of the form
+'unix:<socket path>', eg zaber_tools.zaber_tools('unix:/tmp/uro-zaber.sock');
+daemon_connection provides the part of the ZML binary Connection that
+zaber_tools uses.
+
+The protocol is one JSON object per line. Requests carry an id that is echoed
+in the response, so clients can pipeline requests; events carry 'event'.
+
+Usage:
+    python zaber_daemon.py serve [--port COM9]
+    python zaber_daemon.py monitor
+    python zaber_daemon.py shutdown
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from zaber_motion import Units
+from zaber_motion.binary import BinarySettings, CommandCode
+
+import zaber_tools
+
+DEFAULT_SOCKET = '/tmp/uro-zaber.sock'
+DAEMON_PREFIX = 'unix:'
+
+
+def daemon_available(socket_path=DEFAULT_SOCKET):
+    # True when a daemon accepts connections on socket_path
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def _code(value):
+    # Command codes may be given as CommandCode members
+    return int(getattr(value, 'value', value))
+
+
+def zaber_port(com_port, socket_path=DEFAULT_SOCKET):
+    # The daemon when it is running, the serial port otherwise
+    return DAEMON_PREFIX + socket_path if daemon_available(socket_path) else com_port
+
+
+# ######################################################################
+# SERVER
+# ######################################################################
+class _client_handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+        self.server.daemon.clients.add(self)
+
+    def finish(self):
+        self.server.daemon.clients.discard(self)
+        super().finish()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send({'error': 'invalid request'})
+                continue
+            self.server.daemon.handle(self, request)
+
+    def send(self, msg):
+        data = (json.dumps(msg) + '\n').encode('utf-8')
+        with self.lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                pass  # client went away
+
+
+class _unix_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class zaber_daemon:
+    """Owner of the Zaber connection, serves clients over a Unix socket."""
+
+    def __init__(self, com_port='auto', socket_path=DEFAULT_SOCKET):
+        if daemon_available(socket_path):
+            raise RuntimeError('A Zaber daemon is already running on {}'.format(socket_path))
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # stale socket of a daemon that died
+
+        self.socket_path = socket_path
+        self.clients = set()
+        self._closed = False
+        self.zt = zaber_tools.zaber_tools(com_port)
+        self._subscriptions = [self.zt.connection.reply_only.subscribe(lambda e: self._forward('reply', e)),
+                               self.zt.connection.unknown_response.subscribe(lambda e: self._forward('unknown', e))]
+        self.server = _unix_server(socket_path, _client_handler)
+        self.server.daemon = self
+        os.chmod(socket_path, 0o660)
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        # serve_forever returns, callable from a handler thread
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for subscription in self._subscriptions:
+            subscription.dispose()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.zt.close()
+
+    def info(self):
+        # Port and devices, sent to a client instead of detecting the devices again
+        return {'com_port': self.zt.com_port,
+                'devices': [{'address': address, 'device_id': self.zt.get_setting(address, 50)}
+                            for address in self.zt.devices]}
+
+    def handle(self, client, request):
+        op = request.get('op')
+        rid = request.get('id')
+        priority = request.get('priority', zaber_tools.zaber_dispatcher.PRIORITY_NORMAL)
+        try:
+            if op == 'command':
+                future = self.zt.submit(request['device'], request['command'], request.get('data', 0),
+                                        request.get('timeout', 0.0), request.get('check_errors', True), priority)
+                future.add_done_callback(lambda f: client.send(self._reply(rid, f)))
+            elif op == 'command_no_response':
+                self.zt.submit_no_response(request['device'], request['command'], request.get('data', 0), priority)
+            elif op in ('settings_get', 'settings_set'):
+                settings = self.zt.devices[request['device']].settings
+                args = [BinarySettings[request['setting']]]
+                if op == 'settings_set':
+                    args.append(request['value'])
+                args.append(Units[request.get('unit', 'NATIVE')])
+                fn = settings.get if op == 'settings_get' else settings.set
+                future = self.zt.call(fn, *args, priority=priority)
+                future.add_done_callback(
+                    lambda f: client.send({'id': rid, 'error': str(f.error)} if f.error is not None
+                                          else {'id': rid, 'value': f.reply}))
+            elif op == 'info':
+                client.send(dict(self.info(), id=rid))
+            elif op == 'shutdown':
+                client.send({'id': rid})
+                self.shutdown()
+            else:
+                client.send({'id': rid, 'error': 'unknown op: {}'.format(op)})
+        except Exception as ex:
+            client.send({'id': rid, 'error': '{}: {}'.format(type(ex).__name__, ex)})
+
+    def _reply(self, rid, future):
+        if future.error is not None:
+            return {'id': rid, 'error': str(future.error)}
+        reply = future.reply
+        return {'id': rid, 'device': reply.device_address, 'command': reply.command, 'data': reply.data}
+
+    def _forward(self, kind, event):
+        msg = {'event': kind, 'device': event.device_address, 'command': event.command, 'data': event.data}
+        for client in list(self.clients):
+            client.send(msg)
+
+
+# ######################################################################
+# CLIENT
+# ######################################################################
+class daemon_reply:
+    """Reply or event from a device, same fields as the ZML binary Message."""
+
+    def __init__(self, device_address, command, data):
+        self.device_address = device_address
+        self.command = command
+        self.data = data
+
+    def __repr__(self):
+        return 'daemon_reply(device={}, command={}, data={})'.format(self.device_address, self.command, self.data)
+
+
+class _subscription:
+
+    def __init__(self, subscribers, fn):
+        self.subscribers = subscribers
+        self.fn = fn
+
+    def dispose(self):
+        if self.fn in self.subscribers:
+            self.subscribers.remove(self.fn)
+
+
+class _event_stream:
+    # Minimal stand-in for the observables of the ZML connection
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+        return _subscription(self.subscribers, fn)
+
+    def emit(self, event):
+        for fn in list(self.subscribers):
+            fn(event)
+
+
+class _remote_settings:
+
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+
+    def get(self, setting, unit=Units.NATIVE):
+        return self.connection.request('settings_get', device=self.address, setting=setting.name,
+                                       unit=unit.name)['value']
+
+    def set(self, setting, value, unit=Units.NATIVE):
+        self.connection.request('settings_set', device=self.address, setting=setting.name,
+                                value=value, unit=unit.name)
+
+
+class _remote_identity:
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+
+
+class remote_device:
+    """Device served by the daemon, already identified by the daemon."""
+
+    def __init__(self, connection, address, device_id):
+        self.connection = connection
+        self.device_address = address
+        self.identity = _remote_identity(device_id)
+        self.settings = _remote_settings(connection, address)
+
+    def identify(self):
+        return self.identity
+
+
+class daemon_connection:
+    """Client side of the daemon protocol.
+
+    Implements the calls zaber_tools makes on a ZML binary Connection, a
+    reader thread resolves the responses and dispatches the device events.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, request_timeout=5.0):
+        self.socket_path = socket_path
+        self.request_timeout = request_timeout
+        self.reply_only = _event_stream()
+        self.unknown_response = _event_stream()
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rb')
+        self._thread = threading.Thread(target=self._run, name='zaber-daemon-client', daemon=True)
+        self._thread.start()
+
+    def request(self, op, **kwargs):
+        # Send a request and wait for its response
+        rid = next(self._ids)
+        slot = [threading.Event(), None]
+        with self._lock:
+            self._pending[rid] = slot
+        self._write(dict(kwargs, op=op, id=rid))
+        if not slot[0].wait(self.request_timeout):
+            with self._lock:
+                self._pending.pop(rid, None)
+            raise TimeoutError('Zaber daemon did not answer {} within {} s'.format(op, self.request_timeout))
+        response = slot[1]
+        if response.get('error') is not None:
+            raise RuntimeError('Zaber daemon: {}'.format(response['error']))
+        return response
+
+    def detect_devices(self, identify_devices=True):
+        info = self.request('info')
+        return [remote_device(self, d['address'], d['device_id']) for d in info['devices']]
+
+    def generic_command(self, device, command, data=0, timeout=0.0, check_errors=True):
+        response = self.request('command', device=device, command=_code(command), data=int(data),
+                                timeout=timeout, check_errors=check_errors)
+        return daemon_reply(response['device'], response['command'], response['data'])
+
+    def generic_command_no_response(self, device, command, data=0):
+        self._write({'op': 'command_no_response', 'device': device, 'command': _code(command), 'data': int(data)})
+
+    def shutdown_daemon(self):
+        self.request('shutdown')
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+    def _write(self, msg):
+        data = (json.dumps(msg) + '\n').encode('utf-8')
+        with self._write_lock:
+            self._socket.sendall(data)
+
+    def _run(self):
+        try:
+            for line in self._file:
+                msg = json.loads(line)
+                if 'event' in msg:
+                    stream = self.reply_only if msg['event'] == 'reply' else self.unknown_response
+                    stream.emit(daemon_reply(msg['device'], msg['command'], msg['data']))
+                    continue
+                with self._lock:
+                    slot = self._pending.pop(msg.get('id'), None)
+                if slot is not None:
+                    slot[1] = msg
+                    slot[0].set()
+        except (OSError, ValueError):
+            pass
+        # fail whatever is still waiting
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for slot in pending.values():
+            slot[1] = {'error': 'connection to the daemon closed'}
+            slot[0].set()
+
+
+# ######################################################################
+# COMMAND LINE
+# ######################################################################
+def monitor(socket_path=DEFAULT_SOCKET, device=1, interval=0.5):
+    # Print the position of a device until interrupted
+    zt = zaber_tools.zaber_tools(DAEMON_PREFIX + socket_path)
+    try:
+        while True:
+            resp = zt.submit(device, CommandCode.RETURN_CURRENT_POSITION,
+                             priority=zaber_tools.zaber_dispatcher.PRIORITY_BACKGROUND).result(5.0)
+            print('{:.3f} \tdevice {} \tposition {} µsteps \t{:.3f} mm'.format(
+                time.time(), device, resp.data, zt.dist_mustep_to_mm(resp.data, device)))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        zt.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Zaber connection daemon for the URO tools')
+    parser.add_argument('action', choices=['serve', 'monitor', 'shutdown'])
+    parser.add_argument('--port', default='auto', help='serial port of the Zaber device, auto to probe the ports (serve)')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket of the daemon')
+    parser.add_argument('--device', type=int, default=1, help='device number (monitor)')
+    args = parser.parse_args()
+
+    if args.action == 'serve':
+        daemon = zaber_daemon(args.port, args.socket)
+        print('Zaber daemon on {} serving {}'.format(daemon.zt.com_port, args.socket))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.action == 'monitor':
+        monitor(args.socket, args.device)
+    else:
+        connection = daemon_connection(args.socket)
+        connection.shutdown_daemon()
+        connection.close()
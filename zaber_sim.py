@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Simulated Zaber devices speaking the binary protocol on a pseudo-terminal.
+zaber_tools connects to the simulator like to a real device:
+    sim = zaber_sim.zaber_sim()
+    sim.start()
+    zt = zaber_tools.zaber_tools(sim.port)
+or from the command line: python zaber_sim.py --axes 2, then use the printed
+/dev/pts/N as the Zaber port of the URO tools.
+
+The simulator models
+- the serial line: packets take 10 bits per byte at the baud rate, in each
+  direction, plus the one-way delay of the USB-serial adapter
+- the device: commands are processed one at a time, each taking process_time
+- motion: trapezoidal velocity profiles from the target speed and
+  acceleration settings, limited by the minimum and maximum position; a new
+  move or STOP pre-empts the running move
+- errors: queued errors for a command, random errors and dropped replies
+Several daisy-chained devices (axes) can share the port. Message IDs
+(SET_MESSAGE_ID_MODE) are supported. Linux and macOS only.
+"""
+# Part of the URO library
+# Copyright (C) 2021 Pieter Vandemaele
+# Distributed under the terms of the GNU General Public License (GPL).
+
+import argparse
+import heapq
+import math
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+# Command numbers, see the binary protocol manual
+HOME = 1
+RENUMBER = 2
+MOVE_ABSOLUTE = 20
+MOVE_RELATIVE = 21
+STOP = 23
+SET_TARGET_SPEED = 42
+SET_ACCELERATION = 43
+SET_MAXIMUM_POSITION = 44
+SET_CURRENT_POSITION = 45
+RETURN_DEVICE_ID = 50
+RETURN_FIRMWARE_VERSION = 51
+RETURN_SETTING = 53
+RETURN_STATUS = 54
+RETURN_FIRMWARE_BUILD = 56
+RETURN_CURRENT_POSITION = 60
+RETURN_SERIAL_NUMBER = 63
+SET_MESSAGE_ID_MODE = 102
+SET_MINIMUM_POSITION = 106
+ERROR = 255
+
+# Error codes
+ERROR_ABSOLUTE_POSITION_INVALID = 20
+ERROR_RELATIVE_POSITION_INVALID = 21
+ERROR_SPEED_INVALID = 42
+ERROR_SETTING_INVALID = 53
+ERROR_COMMAND_INVALID = 64
+
+STATUS_IDLE = 0
+
+# Device units
+VELOCITY_DATA_UNIT = 9.375  # microsteps/s per unit of target speed
+ACCELERATION_DATA_UNIT = 11250 / 64  # microsteps/s² per unit of acceleration at resolution 64
+MAX_SPEED_DATA = 2922 * 4  # highest target speed accepted
+
+# Settings a T-LSR150B reports, keyed by set command number
+DEFAULT_SETTINGS = {37: 64,  # microstep resolution
+                    42: 2922,  # target speed
+                    43: 205,  # acceleration
+                    44: 305381,  # maximum position
+                    46: 305381,  # maximum relative move
+                    47: 0,  # home offset
+                    101: 0,
+                    102: 0,  # message id mode
+                    106: 0,  # minimum position
+                    }
+# Commands that may be read with RETURN_SETTING besides the settings
+RETURN_COMMANDS = (RETURN_DEVICE_ID, RETURN_FIRMWARE_VERSION, RETURN_FIRMWARE_BUILD,
+                   RETURN_CURRENT_POSITION, RETURN_SERIAL_NUMBER, RETURN_STATUS)
+
+
+class axis_model:
+    """Trapezoidal motion of a single axis, positions in microsteps.
+
+    The profile is a list of segments (t0, t1, p0, v0, a) with constant
+    acceleration a; outside the segments the axis stands still.
+    """
+
+    def __init__(self, position=0, min_position=0, max_position=305381):
+        self.min_position = min_position
+        self.max_position = max_position
+        self.travel = 0.0  # total distance moved, microsteps
+        self.moves = 0
+        self.low = self.high = position  # range of positions reached
+        self._segments = []
+        self._rest = position  # position after the last segment
+
+    def position_at(self, t):
+        for t0, t1, p0, v0, a in self._segments:
+            if t < t0:
+                return p0
+            if t <= t1:
+                dt = t - t0
+                return p0 + v0 * dt + 0.5 * a * dt * dt
+        return self._rest
+
+    def velocity_at(self, t):
+        for t0, t1, p0, v0, a in self._segments:
+            if t0 <= t <= t1:
+                return v0 + a * (t - t0)
+        return 0.0
+
+    def end_time(self):
+        return self._segments[-1][1] if self._segments else None
+
+    def moving(self, t):
+        return bool(self._segments) and t < self._segments[-1][1]
+
+    def move_to(self, target, t, speed, acceleration):
+        # Start a move to target at time t from the current state (speed in
+        # microsteps/s, acceleration in microsteps/s²), returns the end time
+        p = self.position_at(t)
+        v = self.velocity_at(t)
+        self._cut(t)
+        if v != 0.0:
+            # decelerate first, then move from standstill
+            t, p = self._brake(t, p, v, acceleration)
+        distance = target - p
+        direction = 1.0 if distance >= 0 else -1.0
+        distance = abs(distance)
+        if distance == 0 or speed <= 0 or acceleration <= 0:
+            self._rest = p
+            return t
+
+        t_acc = speed / acceleration
+        d_acc = 0.5 * acceleration * t_acc * t_acc
+        if 2 * d_acc > distance:
+            # triangular profile
+            t_acc = math.sqrt(distance / acceleration)
+            speed = acceleration * t_acc
+            d_acc = distance / 2
+        t_cruise = (distance - 2 * d_acc) / speed
+        a = direction * acceleration
+        v_peak = direction * speed
+        t1 = t + t_acc
+        t2 = t1 + t_cruise
+        t3 = t2 + t_acc
+        self._segments.append((t, t1, p, 0.0, a))
+        self._segments.append((t1, t2, p + direction * d_acc, v_peak, 0.0))
+        self._segments.append((t2, t3, p + direction * (d_acc + speed * t_cruise), v_peak, -a))
+        self._rest = target
+        self.travel += distance
+        self.moves += 1
+        self._reach(target)
+        return t3
+
+    def stop(self, t, acceleration):
+        # Decelerate to standstill from time t, returns the end time
+        p = self.position_at(t)
+        v = self.velocity_at(t)
+        travel_left = abs(self._rest - p)
+        self._cut(t)
+        self.travel -= travel_left
+        if v == 0.0:
+            self._rest = p
+            return t
+        t_end, p_end = self._brake(t, p, v, acceleration)
+        self.travel += abs(p_end - p)
+        return t_end
+
+    def set_position(self, position):
+        self._segments = []
+        self._rest = position
+        self.low = self.high = position
+
+    def _brake(self, t, p, v, acceleration):
+        a = -math.copysign(acceleration, v)
+        t_dec = abs(v) / acceleration
+        p_end = p + v * t_dec + 0.5 * a * t_dec * t_dec
+        self._segments.append((t, t + t_dec, p, v, a))
+        self._rest = p_end
+        self._reach(p_end)
+        return t + t_dec, p_end
+
+    def _reach(self, position):
+        self.low = min(self.low, position)
+        self.high = max(self.high, position)
+
+    def _cut(self, t):
+        # Drop the part of the profile after t
+        kept = []
+        for t0, t1, p0, v0, a in self._segments:
+            if t0 >= t:
+                break
+            kept.append((t0, min(t1, t), p0, v0, a))
+        self._segments = kept
+
+
+class sim_device:
+    """State of one simulated device in the chain."""
+
+    def __init__(self, device_number=1, device_id=30222, serial=12345, firmware=706, settings=None):
+        self.device_number = device_number
+        self.device_id = device_id
+        self.serial = serial
+        self.firmware = firmware
+        self.settings = dict(DEFAULT_SETTINGS if settings is None else settings)
+        self.axis = axis_model(0, self.settings[SET_MINIMUM_POSITION], self.settings[SET_MAXIMUM_POSITION])
+        self.move = 0  # id of the running move, pre-empted moves do not reply
+        self.move_command = None
+
+    def speed(self):
+        return self.settings[SET_TARGET_SPEED] * VELOCITY_DATA_UNIT
+
+    def acceleration(self):
+        return max(self.settings[SET_ACCELERATION], 1) * ACCELERATION_DATA_UNIT * self.settings[37]
+
+    def handle(self, command, data, t):
+        """Execute a command at time t.
+
+        Returns (command, data, t_reply, move id): the reply is sent at t_reply,
+        move id is not None for replies that a later move cancels.
+        """
+        axis = self.axis
+        if command in RETURN_COMMANDS:
+            return command, self.value(command, t), t, None
+        if command == RETURN_SETTING:
+            if data in self.settings:
+                return data, self.settings[data], t, None
+            if data in RETURN_COMMANDS:
+                return data, self.value(data, t), t, None
+            return ERROR, ERROR_SETTING_INVALID, t, None
+        if command in (MOVE_ABSOLUTE, MOVE_RELATIVE, HOME):
+            position = int(round(axis.position_at(t)))
+            target = {MOVE_ABSOLUTE: data, MOVE_RELATIVE: position + data, HOME: 0}[command]
+            if not axis.min_position <= target <= axis.max_position:
+                code = ERROR_RELATIVE_POSITION_INVALID if command == MOVE_RELATIVE else ERROR_ABSOLUTE_POSITION_INVALID
+                return ERROR, code, t, None
+            self.move += 1
+            self.move_command = command
+            t_end = axis.move_to(target, t, self.speed(), self.acceleration())
+            return command, target, t_end, self.move
+        if command == STOP:
+            self.move += 1
+            self.move_command = STOP
+            t_end = axis.stop(t, self.acceleration())
+            return command, int(round(axis.position_at(t_end))), t_end, self.move
+        if command == SET_CURRENT_POSITION:
+            axis.set_position(data)
+            return command, data, t, None
+        if command == SET_TARGET_SPEED and not 0 < data <= MAX_SPEED_DATA:
+            return ERROR, ERROR_SPEED_INVALID, t, None
+        if command in self.settings:
+            self.settings[command] = data
+            axis.min_position = self.settings[SET_MINIMUM_POSITION]
+            axis.max_position = self.settings[SET_MAXIMUM_POSITION]
+            return command, data, t, None
+        return ERROR, ERROR_COMMAND_INVALID, t, None
+
+    def value(self, command, t):
+        if command == RETURN_DEVICE_ID:
+            return self.device_id
+        if command == RETURN_FIRMWARE_VERSION:
+            return self.firmware
+        if command == RETURN_SERIAL_NUMBER:
+            return self.serial
+        if command == RETURN_CURRENT_POSITION:
+            return int(round(self.axis.position_at(t)))
+        if command == RETURN_STATUS:
+            return self.move_command if self.axis.moving(t) else STATUS_IDLE
+        return 0
+
+
+class zaber_sim:
+    """Chain of simulated Zaber devices on a pseudo-terminal."""
+
+    def __init__(self, axes=1, baud=9600, link_delay=0.001, process_time=0.0005,
+                 error_rate=0.0, drop_rate=0.0, seed=None, **device):
+        # baud: None for an infinitely fast line
+        # link_delay: one-way delay of the adapter in s, process_time: device time per command in s
+        # error_rate, drop_rate: probability of a random error reply or of a lost reply
+        # device: keyword arguments of sim_device, shared by all axes
+        self.baud = baud
+        self.link_delay = link_delay
+        self.process_time = process_time
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        serial = device.pop('serial', 12345)
+        self.devices = [sim_device(n, serial=serial + n - 1, **device) for n in range(1, axes + 1)]
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self._errors = []  # queued errors: [device number, command, error code, count]
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._rx_free = 0.0
+        self._tx_free = 0.0
+        self._busy_until = {}
+        self._replies = []  # heap of (send time, seq, packet, device, move id)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._read, name='zaber-sim-rx', daemon=True),
+                         threading.Thread(target=self._write, name='zaber-sim-tx', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        # the threads must be gone before the descriptor numbers can be reused
+        for thread in self._threads:
+            thread.join(1.0)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def device(self, device_number=1):
+        return self.devices[device_number - 1]
+
+    def inject_error(self, command, code=None, count=1, device_number=None):
+        # The next count commands with this number are answered with error code;
+        # the default is the command number, the code the devices report for
+        # invalid data. ZML only matches that code or 64 and 255 to the command,
+        # other codes make the command time out.
+        with self._cond:
+            self._errors.append([device_number, command, code, count])
+
+    def packet_time(self):
+        # Time a 6 byte packet occupies the line, 10 bits per byte
+        return 0.0 if self.baud is None else 60.0 / self.baud
+
+    @property
+    def message_ids(self):
+        return self.devices[0].settings.get(SET_MESSAGE_ID_MODE, 0) == 1
+
+    # #### PROTOCOL
+    def decode(self, packet):
+        # device, command, data, message id
+        if self.message_ids:
+            data = int.from_bytes(packet[2:5], 'little', signed=True)
+            return packet[0], packet[1], data, packet[5]
+        return packet[0], packet[1], struct.unpack('<i', packet[2:6])[0], None
+
+    def encode(self, device_number, command, data, message_id):
+        if message_id is not None:
+            data = max(-(1 << 23), min((1 << 23) - 1, int(data)))
+            return bytes([device_number, command]) + data.to_bytes(3, 'little', signed=True) + bytes([message_id])
+        return bytes([device_number, command]) + struct.pack('<i', int(data))
+
+    def _injected(self, device_number, command):
+        for entry in self._errors:
+            if entry[1] == command and entry[0] in (None, device_number):
+                entry[3] -= 1
+                if entry[3] <= 0:
+                    self._errors.remove(entry)
+                return command if entry[2] is None else entry[2]
+        if self.error_rate > 0 and self.rng.random() < self.error_rate:
+            return command
+        return None
+
+    # #### THREADS
+    def _read(self):
+        buffer = b''
+        while self._running:
+            try:
+                if not select.select([self.master], [], [], 0.1)[0]:
+                    continue
+                chunk = os.read(self.master, 256)
+            except OSError:
+                break
+            now = time.perf_counter()
+            buffer += chunk
+            while len(buffer) >= 6:
+                packet, buffer = buffer[:6], buffer[6:]
+                self.received += 1
+                self._receive(packet, now)
+
+    def _receive(self, packet, now):
+        # the packet is complete once its last byte crossed the line
+        arrived = max(now + self.link_delay, self._rx_free) + self.packet_time()
+        self._rx_free = arrived
+        device_number, command, data, message_id = self.decode(packet)
+
+        for device in self.devices:
+            if device_number not in (0, device.device_number):
+                continue
+            # each device executes its commands one at a time
+            start = max(arrived, self._busy_until.get(device.device_number, 0.0))
+            done = start + self.process_time
+            self._busy_until[device.device_number] = done
+            with self._cond:
+                code = self._injected(device.device_number, command)
+            if code is not None:
+                reply = (ERROR, code, done, None)
+            else:
+                reply = device.handle(command, data, done)
+            reply_id = message_id
+            if command == SET_MESSAGE_ID_MODE:
+                reply_id = None  # answered in the mode the command was sent in
+            if self.drop_rate > 0 and self.rng.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            self._schedule(reply[2], self.encode(device.device_number, reply[0], reply[1], reply_id),
+                           device, reply[3])
+
+    def _schedule(self, t, packet, device, move):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._replies, (t, self._seq, packet, device, move))
+            self._cond.notify()
+
+    def _write(self):
+        while self._running:
+            with self._cond:
+                while self._running and not self._replies:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                t, seq, packet, device, move = self._replies[0]
+                if move is not None and move != device.move:
+                    heapq.heappop(self._replies)  # pre-empted move, no reply
+                    continue
+                # the reply waits for the line, then crosses the adapter
+                t_send = max(t, self._tx_free) + self.packet_time()
+                delay = t_send + self.link_delay - time.perf_counter()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._replies)
+                self._tx_free = t_send
+            try:
+                os.write(self.master, packet)
+                self.sent += 1
+            except OSError:
+                break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated Zaber binary protocol devices on a pseudo-terminal')
+    parser.add_argument('--axes', type=int, default=1, help='number of daisy-chained devices')
+    parser.add_argument('--baud', type=int, default=9600, help='baud rate, 0 for an infinitely fast line')
+    parser.add_argument('--link-delay', type=float, default=0.001, help='one-way adapter delay (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of an error reply')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a lost reply')
+    args = parser.parse_args()
+
+    with zaber_sim(args.axes, args.baud or None, args.link_delay,
+                   error_rate=args.error_rate, drop_rate=args.drop_rate) as sim:
+        print('Simulated Zaber device(s) on {}, Ctrl+C to stop'.format(sim.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
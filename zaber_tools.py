@@ -5,6 +5,26 @@ calculations
 Features:
 - Connect to a Zaber device
 - Conversions of distance and velocity to and from microsteps and millimeter
+- Event-driven move completion (no polling of the device while it moves)
+- A dispatcher thread that owns the serial connection, commands are queued
+  and return futures with send and reply timestamps
+- Position telemetry recorded into a memory-mapped ring buffer
+- Several daisy-chained devices (axes) on one port, moves on several axes
+  can be started together with a broadcast or a pipelined burst
+- A snapshot of the device identity and static settings is kept on disk per
+  port, the next connection only checks the serial number of each device
+  instead of detecting and identifying the devices again
+- A write-through cache of the device settings, writes that do not change a
+  setting are not sent
+- A local model of the device positions, kept up to date from the replies so
+  the position rarely has to be queried
+- Pipelined transport (message_ids=True): commands are tagged with message
+  IDs so a batch of commands is in flight at once and the replies are
+  matched as they arrive
+- Auto-discovery of the serial port (com_port='auto'), all candidate ports
+  are probed in parallel and the winning port is cached
+- Connect through the zaber_daemon with a com_port of the form
+  'unix:<socket path>', the port then stays open between the tools
 
 Adjust the parameters between the dashed lines according to your device.
 For detailed information and an example, see the README.TXT file shipped with
@@ -13,7 +33,20 @@ Copyright (C) 2018 Pieter Vandemaele
 Distributed under the terms of the GNU General Public License (GPL).
 """
 
+import asyncio
+import concurrent.futures
+import glob
+import itertools
+import json
+import os
+import pathlib as pl
+import queue
+import threading
+import time
+
+import numpy as np
 from zaber_motion import Library
+from zaber_motion import DeviceDbFailedException
 from zaber_motion import DeviceDbSourceType
 from zaber_motion import LogOutputMode
 from zaber_motion import Units, FirmwareVersion, Measurement, Tools
@@ -25,6 +58,400 @@ from zaber_motion.binary import CommandCode, ReplyCode, ErrorCode
 from zaber_motion.binary import DeviceIdentity
 from zaber_motion.binary import ReplyOnlyEvent
 
+# Device snapshots, bump SNAPSHOT_VERSION when the layout changes
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DIR = './zaber-cache'
+# Settings (RETURN_SETTING data) that do not change during a session:
+# microstep resolution, device id, maximum and minimum position
+SNAPSHOT_SETTINGS = (37, 50, 44, 106)
+# Upper bound on the wait for the replies of all axes to a broadcast, reached
+# only when a device of the snapshot does not answer; once all have answered
+# the verify waits SNAPSHOT_VERIFY_GRACE for an added axis, one reply takes
+# about 6 ms at 9600 baud
+SNAPSHOT_VERIFY_TIMEOUT = 0.1
+SNAPSHOT_VERIFY_GRACE = 0.01
+PORT_CACHE = 'port.json'
+
+# Set commands whose value is cached by the settings layer, the reply to a set
+# command and to RETURN_SETTING carries the setting number as command code.
+# Settings that change without a set command are not cached.
+VOLATILE_SETTINGS = [c.value for c in (CommandCode.SET_CURRENT_POSITION, CommandCode.SET_HOME_STATUS,
+                                       CommandCode.SET_PARK_STATE)]
+CACHED_SETTINGS = set(c.value for c in CommandCode
+                      if c.name.startswith('SET_') and c.value not in VOLATILE_SETTINGS) | set(SNAPSHOT_SETTINGS)
+# Commands after which the cached settings of a device are unknown
+RESET_CODES = [c.value for c in (CommandCode.RESET, CommandCode.RESTORE_SETTINGS, CommandCode.RENUMBER)]
+
+# Replies sent by the device when a motion command has finished
+MOVE_COMPLETE_CODES = [c.value for c in (CommandCode.HOME, CommandCode.MOVE_TO_STORED_POSITION,
+                                          CommandCode.MOVE_ABSOLUTE, CommandCode.MOVE_RELATIVE,
+                                          CommandCode.STOP, CommandCode.MOVE_INDEX)]
+
+# Replies that carry the current position of the device
+POSITION_CODES = set(MOVE_COMPLETE_CODES) | set(
+    c.value for c in (CommandCode.RETURN_CURRENT_POSITION, CommandCode.SET_CURRENT_POSITION)) | set(
+    r.value for r in ReplyCode if r != ReplyCode.ERROR)
+
+
+# #### PORT DISCOVERY
+def candidate_ports():
+    # Serial ports that may have a Zaber device attached
+    try:
+        ports = list(Tools.list_serial_ports())
+    except Exception:
+        ports = []
+    if not ports:
+        if os.name == 'nt':
+            ports = ['COM{}'.format(i) for i in range(1, 33)]
+        else:
+            ports = sorted(glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*'))
+    return ports
+
+
+def probe_port(port, timeout=0.3, device=1):
+    # Device ID of the Zaber device on port, None when nothing answers in time
+    try:
+        connection = Connection.open_serial_port(port)
+    except Exception:
+        return None
+    try:
+        return connection.generic_command(device, CommandCode.RETURN_DEVICE_ID, timeout=timeout).data
+    except Exception:
+        return None
+    finally:
+        connection.close()
+
+
+def set_message_id_mode(port, enabled):
+    # Switch all devices on port to or from message ID mode, the mode has to
+    # match the use_message_ids flag the connection is opened with
+    connection = Connection.open_serial_port(port, use_message_ids=not enabled)
+    try:
+        connection.generic_command_no_response(0, CommandCode.SET_MESSAGE_ID_MODE, 1 if enabled else 0)
+        time.sleep(0.05)  # let the devices apply the mode before the port is reopened
+    finally:
+        connection.close()
+
+
+def cached_port(cache_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(cache_dir, PORT_CACHE)) as f:
+            return json.load(f)['port']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def discover_port(candidates=None, timeout=0.3, cache_dir=SNAPSHOT_DIR, exclude=()):
+    """Find the serial port of the Zaber device.
+
+    The cached port of the last discovery is tried first. When it does not
+    answer, all other candidate ports are probed at the same time, each with
+    a timeout of timeout seconds, so a wrong port costs one timeout instead
+    of a failed connection. exclude lists ports that must not be touched, eg
+    the port of the scanner trigger.
+    Returns the port and device ID of the first device that answers and
+    caches the port. Raises ValueError when no port answers.
+    """
+    ports = list(candidates) if candidates is not None else candidate_ports()
+    ports = [p for p in ports if p not in exclude]
+    last = cached_port(cache_dir) if cache_dir is not None else None
+    port, device_id = None, None
+    if last is not None and last not in exclude:
+        device_id = probe_port(last, timeout)
+        port = last if device_id is not None else None
+        ports = [p for p in ports if p != last]
+
+    if port is None:
+        if not ports:
+            raise ValueError('No Zaber device found, no serial ports to probe')
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix='zaber-probe')
+        try:
+            probes = {pool.submit(probe_port, p, timeout): p for p in ports}
+            for probe in concurrent.futures.as_completed(probes):
+                if probe.result() is not None:
+                    port, device_id = probes[probe], probe.result()
+                    break
+            else:
+                raise ValueError('No Zaber device found on {}'.format(', '.join(ports)))
+        finally:
+            # the other probes close their port when they time out
+            pool.shutdown(wait=False)
+
+    if cache_dir is not None and port != last:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(os.path.join(cache_dir, PORT_CACHE), 'w') as f:
+                json.dump({'port': port, 'device_id': device_id}, f)
+        except OSError:
+            pass
+    return port, device_id
+
+
+def setting_code(setting):
+    # Command number of a setting given as number, CommandCode or BinarySettings
+    if isinstance(setting, BinarySettings):
+        return CommandCode['SET_' + setting.name].value
+    return getattr(setting, 'value', setting)
+
+
+def command_code(command):
+    # ZML only accepts CommandCode members
+    return command if isinstance(command, CommandCode) else CommandCode(command)
+
+
+class zaber_future:
+    """Waitable result of an operation handled by another thread."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.error = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        # Block until the operation is finished, return False on timeout
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError('{} did not finish within {} s'.format(self, timeout))
+        if self.error is not None:
+            raise self.error
+        return self._result()
+
+    def add_done_callback(self, fn):
+        # Call fn(future) on completion, immediately if already done
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _result(self):
+        return None
+
+    def _complete(self, **kwargs):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+
+class zaber_command(zaber_future):
+    """Command queued on the dispatcher.
+
+    submit_time, send_time and reply_time are taken from the clock of the
+    owning zaber_tools object.
+    """
+
+    def __init__(self, device, command, data, clock):
+        super().__init__(clock)
+        self.device = device
+        self.command = command
+        self.data = data
+        self.submit_time = clock()
+        self.send_time = None
+        self.reply_time = None
+        self.reply = None
+
+    def __repr__(self):
+        return 'zaber_command(device={}, command={}, data={})'.format(self.device, self.command, self.data)
+
+    def latency(self):
+        # Time between sending the command and receiving the reply
+        if self.reply_time is None or self.send_time is None:
+            return None
+        return self.reply_time - self.send_time
+
+    def _result(self):
+        return self.reply
+
+
+class zaber_move(zaber_future):
+    """Waitable handle for a single device movement.
+
+    The handle is completed from the unsolicited reply the device sends when
+    the movement finishes, so waiting on it does not generate serial traffic.
+    transactions counts the serial transactions addressed to the device from
+    the start to the end of the move, background jobs (position polls of a
+    position_recorder) excluded.
+    """
+
+    def __init__(self, device, command, data, clock, transactions=0):
+        super().__init__(clock)
+        self.device = device
+        self.command = command
+        self.data = data
+        self.request = None  # zaber_command that carried the move
+        self.setting_errors = []  # settings sent with the move that the device rejected
+        self.start_time = clock()
+        self.end_time = None
+        self.position = None
+        self.interrupted = False
+        self.transactions = 0
+        self._transactions_start = transactions
+
+    def __repr__(self):
+        return 'zaber_move(device={}, command={}, data={})'.format(self.device, self.command, self.data)
+
+    def duration(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def _result(self):
+        # Final position in microsteps
+        return self.position
+
+    def _finish(self, position=None, error=None, interrupted=False, transactions=0):
+        self._complete(end_time=self.clock(), position=position, error=error, interrupted=interrupted,
+                       transactions=transactions - self._transactions_start)
+
+
+class zaber_move_group(zaber_future):
+    """Waitable handle for moves started together on several axes."""
+
+    def __init__(self, moves, clock):
+        super().__init__(clock)
+        self.moves = list(moves)
+        self.device = tuple(m.device for m in self.moves)
+        self._left = len(self.moves)
+        for move in self.moves:
+            move.add_done_callback(self._done)
+
+    def __repr__(self):
+        return 'zaber_move_group(devices={})'.format(self.device)
+
+    @property
+    def request(self):
+        return self.moves[0].request if self.moves else None
+
+    @property
+    def start_time(self):
+        return min(m.start_time for m in self.moves)
+
+    @property
+    def end_time(self):
+        if not self.done():
+            return None
+        return max(m.end_time for m in self.moves)
+
+    @property
+    def interrupted(self):
+        return any(m.interrupted for m in self.moves)
+
+    @property
+    def transactions(self):
+        return max([m.transactions for m in self.moves], default=0)
+
+    @property
+    def setting_errors(self):
+        return [e for m in self.moves for e in m.setting_errors]
+
+    def duration(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def spread(self):
+        # Time between the first and the last move being sent
+        starts = [m.start_time for m in self.moves]
+        return max(starts) - min(starts)
+
+    def _result(self):
+        # Final position of each axis, keyed by device number
+        return {m.device: m.position for m in self.moves}
+
+    def _done(self, move):
+        with self._lock:
+            self._left -= 1
+            left = self._left
+        if left == 0:
+            errors = [m.error for m in self.moves if m.error is not None]
+            self._complete(error=errors[0] if errors else None)
+
+
+class zaber_dispatcher:
+    """Worker thread that owns the serial connection.
+
+    Jobs are taken from a bounded priority queue so callers never block on
+    serial I/O; each job returns a zaber_command future.
+    """
+    PRIORITY_URGENT = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, clock, maxsize=32, put_timeout=0.1):
+        self.clock = clock
+        self.put_timeout = put_timeout
+        self._queue = queue.PriorityQueue(maxsize)
+        self._seq = itertools.count()
+        self._closed = False
+        self.priority = None  # priority of the running job
+        self._thread = threading.Thread(target=self._run, name='zaber-dispatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, future, priority=PRIORITY_NORMAL):
+        # Queue fn(future) on the dispatcher thread, raises queue.Full when the queue is saturated
+        if self._closed:
+            raise RuntimeError('Zaber dispatcher is closed')
+        self._queue.put((priority, next(self._seq), fn, future), timeout=self.put_timeout)
+        return future
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def wait_idle(self, timeout=None):
+        # Block until every queued job has run, returns False on timeout;
+        # returns at once when the dispatcher is closed
+        if self._closed:
+            return True
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: self._queue.unfinished_tasks == 0, timeout)
+
+    def in_dispatcher(self):
+        return threading.current_thread() is self._thread
+
+    def in_background(self):
+        # Whether the caller is a background job on the dispatcher thread
+        return self.in_dispatcher() and self.priority == self.PRIORITY_BACKGROUND
+
+    def _run(self):
+        while True:
+            priority, seq, fn, future = self._queue.get()
+            if fn is None:
+                self._queue.task_done()
+                break
+            future.send_time = self.clock()
+            self.priority = priority
+            try:
+                reply = fn(future)
+            except Exception as ex:
+                future._complete(reply_time=self.clock(), error=ex)
+            else:
+                future._complete(reply_time=self.clock(), reply=reply)
+            self.priority = None
+            self._queue.task_done()
+
+    def close(self, timeout=2.0):
+        # Finish the queued jobs and stop the thread
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((self.PRIORITY_BACKGROUND + 1, next(self._seq), None, None))
+        if not self.in_dispatcher():
+            self._thread.join(timeout)
+
 
 class zaber_tools:
     # #### ZABER SPECIFIC SETTINGS
@@ -38,8 +465,8 @@ class zaber_tools:
     # -------------------------------------------------
     
     
-    zb_microstep_size = 0  # µm
-    zb_microstep_resolution = 0  # steps
+    zb_microstep_size = 0  # µm, of the first device
+    zb_microstep_resolution = 0  # steps, of the first device
     connection = []
 
     # #### CONVERSION FUNCTIONS
@@ -47,23 +474,82 @@ class zaber_tools:
     # data = data returned from the device
     # vel = velocity sent to system
 
-    def __init__(self, com_port='COM9'):
+    def __init__(self, com_port='auto', clock=None, queue_size=32, connection=None, snapshot_dir=SNAPSHOT_DIR,
+                 message_ids=False):
+        # com_port: serial port, 'auto' to discover it, or 'unix:<socket>' for the daemon
+        # connection: an already opened connection with the ZML binary Connection API
+        # snapshot_dir: folder of the device snapshots, None to always detect the devices
+        # message_ids: pipelined transport, the devices are switched to message ID
+        #   mode for the session; data is limited to 24 bits in this mode
         self.com_port = com_port
+        self.message_ids = False
+        self.clock = clock if clock is not None else time.perf_counter
+        self.dispatcher = None
+        self.transactions = 0  # serial transactions initiated by this object
+        self.device_transactions = {}  # {device: transactions}, without background jobs, charged to the moves
+        self._moves = {}
+        self._moves_lock = threading.Lock()
+        self.serials = {}  # serial number per device
+        self.settings_cache = {}  # {device: {setting: value}}
+        self.shared = False  # other clients of the daemon can change the settings
+        self.settings_stats = {'reads': 0, 'writes': 0, 'saved_reads': 0, 'saved_writes': 0}
+        self._settings_lock = threading.Lock()
+        self._snapshot_dirty = False
+        self.positions = {}  # {device: (position in microsteps, clock time)} from the replies
+        self.position_stats = {'queries': 0, 'saved': 0}
+        self._position_lock = threading.Lock()
+        self.snapshot_file = None
+        self.snapshot_hit = False
+        self.connect_phases = []  # (phase, seconds) of the connection
+        self._connected = False
+        t = time.perf_counter()
         try:
-            # Update device database
-            Library.enable_device_db_store()  # default file
-            Library.enable_device_db_store("./device-db-store")  # custom file
+            if connection is not None:
+                self.connection = connection
+            elif str(self.com_port).startswith('unix:'):
+                # the daemon keeps the port open and has identified the devices
+                import zaber_daemon
+                self.connection = zaber_daemon.daemon_connection(self.com_port[len('unix:'):])
+                self.shared = True
+            else:
+                # Update device database
+                Library.enable_device_db_store()  # default file
+                Library.enable_device_db_store("./device-db-store")  # custom file
+                t = self._phase('device db', t)
+
+                if self.com_port == 'auto':
+                    self.com_port = discover_port(cache_dir=snapshot_dir or SNAPSHOT_DIR)[0]
+                    t = self._phase('discover', t)
+
+                # Connect to device
+                if message_ids:
+                    set_message_id_mode(self.com_port, True)
+                    self.message_ids = True
+                self.connection = Connection.open_serial_port(self.com_port, use_message_ids=self.message_ids)
+                if snapshot_dir is not None:
+                    self.snapshot_file = pl.Path(snapshot_dir, self._port_key() + '.json')
+            t = self._phase('open', t)
+            self._subscriptions = [self.connection.reply_only.subscribe(self._on_reply),
+                                   self.connection.unknown_response.subscribe(self._on_reply)]
+            self.dispatcher = zaber_dispatcher(self.clock, maxsize=queue_size)
 
-            # Connect to device
-            self.connection = Connection.open_serial_port(self.com_port)
-            device_list = self.connection.detect_devices()
-            self.device = device_list[0]
-            self.device.identify()
+            # fast path: the devices in the snapshot are still on the port
+            if self.snapshot_file is not None:
+                self.snapshot_hit = self._load_snapshot(t)
+            if not self.snapshot_hit:
+                self._discover()
+                self.save_snapshot()
 
             # Retrieve some information
-            resp = self.connection.generic_command(1, CommandCode.RETURN_SETTING,  37, timeout=0.0, check_errors=True)
-            self.zb_microstep_resolution = resp.data
-            self.zb_microstep_size = self.zb_linear_motion_per_revolution / (self.zb_steps_per_revolution * self.zb_microstep_resolution * 4) * 1000  # what is 4?
+            self.zb_microstep_resolutions = {}
+            self.zb_microstep_sizes = {}
+            for address in self.devices:
+                resolution = self.get_setting(address, 37)
+                self.zb_microstep_resolutions[address] = resolution
+                self.zb_microstep_sizes[address] = self.zb_linear_motion_per_revolution / (self.zb_steps_per_revolution * resolution * 4) * 1000  # what is 4?
+            self.zb_microstep_resolution = self.zb_microstep_resolutions[self.device.device_address]
+            self.zb_microstep_size = self.zb_microstep_sizes[self.device.device_address]
+            self._connected = True
 
             self.errorDict = {1: ['Cannot home', 'Home - Device has traveled a long distance without triggering the home sensor. Device may be stalling or slipping.'],
                               2: ['Device number invalid', 'Renumbering data out of range.'],
@@ -111,40 +597,759 @@ class zaber_tools:
             print('Maximum speed: {} mm/s'.format(self.zb_max_speed))
             print('Steps per revolution: {} steps'.format(self.zb_steps_per_revolution))
             print('Linear motion per revolution: {} mm'.format(self.zb_linear_motion_per_revolution))
-            print('Microstep size: {} µm'.format(self.zb_microstep_size))
-            print('Microstep resolution: {} steps'.format(self.zb_microstep_resolution))
+            for address in self.devices:
+                print('Device {}: microstep size: {} µm, microstep resolution: {} steps'.format(
+                    address, self.zb_microstep_sizes[address], self.zb_microstep_resolutions[address]))
+            print('Connected in {:.1f} ms ({}): {}'.format(
+                self.connect_time() * 1000, 'snapshot' if self.snapshot_hit else 'full discovery',
+                ', '.join('{} {:.1f} ms'.format(name, dt * 1000) for name, dt in self.connect_phases)))
+
+    # #### DEVICE SNAPSHOT
+    def connect_time(self):
+        return sum(dt for name, dt in self.connect_phases)
+
+    def get_setting(self, device, setting):
+        # Value of a setting (RETURN_SETTING data), read from the device only
+        # when it is not cached, static settings come from the snapshot
+        setting = setting_code(setting)
+        with self._settings_lock:
+            cached = self.settings_cache.get(device, {})
+            if setting in cached and self._trusted(setting):
+                self.settings_stats['saved_reads'] += 1
+                return cached[setting]
+        value = self.command(device, CommandCode.RETURN_SETTING, setting, timeout=0.0, check_errors=True).data
+        self.settings_stats['reads'] += 1
+        self._cache_setting(device, setting, value)
+        if setting in SNAPSHOT_SETTINGS and self._connected:
+            self.save_snapshot()  # a setting read after connecting
+        return value
+
+    def set_setting(self, device, setting, value, priority=zaber_dispatcher.PRIORITY_NORMAL):
+        """Write a setting in native units through the settings cache.
+
+        setting is a set command (CommandCode or its number) or a
+        BinarySettings member. The write is skipped when the cached value is
+        already value, except on a daemon connection; device 0 writes all axes. Returns a zaber_command
+        future, completed at once for a skipped write.
+        """
+        setting = setting_code(setting)
+        value = int(value)
+        devices = list(self.devices) if device == 0 else [device]
+        with self._settings_lock:
+            unchanged = self._trusted(setting) and all(self.settings_cache.get(d, {}).get(setting) == value
+                                                       for d in devices)
+            if unchanged:
+                self.settings_stats['saved_writes'] += 1
+        if unchanged:
+            future = zaber_command(device, setting, value, self.clock)
+            future._complete(reply_time=future.submit_time)
+            return future
+
+        self.settings_stats['writes'] += 1
+        if device == 0:
+            # every axis replies to a broadcast, the replies update the cache
+            return self.submit_no_response(device, setting, value, priority)
+
+        def written(future):
+            if future.error is not None:
+                self.invalidate_settings(device, setting)
+            else:
+                self._cache_setting(device, setting, future.reply.data)
+
+        future = self.submit(device, setting, value, priority=priority)
+        future.add_done_callback(written)
+        return future
+
+    def invalidate_settings(self, device=None, setting=None):
+        # Forget a cached setting, all settings of a device, or everything
+        with self._settings_lock:
+            if device is None:
+                self.settings_cache = {}
+            elif setting is None:
+                self.settings_cache.pop(device, None)
+            else:
+                self.settings_cache.get(device, {}).pop(setting, None)
+        if setting is None or setting in SNAPSHOT_SETTINGS:
+            self._snapshot_dirty = True
+
+    def _trusted(self, setting):
+        # Whether a cached value can be used instead of the device: on a daemon
+        # connection other clients write settings without this cache seeing it,
+        # only the static snapshot settings are used there
+        return not self.shared or setting in SNAPSHOT_SETTINGS
+
+    def settings_saved(self):
+        # Serial round-trips saved by the settings cache
+        return self.settings_stats['saved_reads'] + self.settings_stats['saved_writes']
+
+    def _cache_setting(self, device, setting, value):
+        if setting not in CACHED_SETTINGS:
+            return
+        with self._settings_lock:
+            cached = self.settings_cache.setdefault(device, {})
+            if setting in SNAPSHOT_SETTINGS and cached.get(setting) != value:
+                self._snapshot_dirty = True
+            cached[setting] = value
+
+    def save_snapshot(self):
+        if self.snapshot_file is None:
+            return
+        # only the static settings, the others are read again after a reconnect
+        with self._settings_lock:
+            settings = {address: {str(k): v for k, v in self.settings_cache.get(address, {}).items()
+                                  if k in SNAPSHOT_SETTINGS}
+                        for address in self.devices}
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'com_port': str(self.com_port),
+                    'devices': [{'address': address, 'serial': self.serials.get(address), 'settings': settings[address]}
+                                for address in self.devices]}
+        try:
+            self.snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.snapshot_file.with_suffix('.tmp')
+            with open(str(tmp_file), 'w') as f:
+                json.dump(snapshot, f, indent=1)
+            os.replace(str(tmp_file), str(self.snapshot_file))
+            self._snapshot_dirty = False
+        except OSError:
+            pass  # the snapshot is an optimisation only
 
-    def dist_mm_to_mustep(self, dist_mm):
+    def invalidate_snapshot(self):
+        # The next connection does a full discovery
+        if self.snapshot_file is not None and self.snapshot_file.exists():
+            self.snapshot_file.unlink()
+
+    def _phase(self, name, t):
+        # Record the time since t for a connection phase, returns the new start time
+        now = time.perf_counter()
+        self.connect_phases.append((name, now - t))
+        return now
+
+    def _port_key(self):
+        return ''.join(c if c.isalnum() else '_' for c in str(self.com_port)).strip('_')
+
+    def _read_serial(self, address):
+        try:
+            return self.command(address, CommandCode.RETURN_SERIAL_NUMBER, timeout=0.0, check_errors=True).data
+        except Exception:
+            return None  # not supported by older firmware
+
+    def _chain_serials(self, expected):
+        # Serial number of every axis on the port from one broadcast, so axes
+        # added or removed since the snapshot are noticed as well; returns
+        # once the expected devices and no other device answered for a grace
+        # period. ZML waits the full timeout for a multi response broadcast,
+        # the replies are collected from the unsolicited replies instead.
+        serials = {}
+        answered = threading.Event()
+
+        def on_reply(event):
+            if event.command == CommandCode.RETURN_SERIAL_NUMBER.value:
+                serials[event.device_address] = event.data
+                if all(address in serials for address in expected):
+                    answered.set()
+
+        subscription = self.connection.unknown_response.subscribe(on_reply)
+        try:
+            self.connection.generic_command_no_response(0, CommandCode.RETURN_SERIAL_NUMBER)
+            if answered.wait(SNAPSHOT_VERIFY_TIMEOUT):
+                time.sleep(SNAPSHOT_VERIFY_GRACE)
+        except Exception:
+            return None
+        finally:
+            subscription.dispose()
+        return dict(serials)
+
+    def _discover(self):
+        t = time.perf_counter()
+        # identified below, once, with a fallback when the device database is offline
+        device_list = self.connection.detect_devices(identify_devices=False)
+        if not device_list:
+            raise ValueError('No Zaber devices found on {}'.format(self.com_port))
+        # all axes in the chain, keyed by device number
+        self.devices = {d.device_address: d for d in device_list}
+        self.device = device_list[0]
+        t = self._phase('detect', t)
+        try:
+            for device in device_list:
+                device.identify()
+        except DeviceDbFailedException as ex:
+            # identification only adds unit conversions, everything here uses native units
+            print('Zaber device database not available, devices not identified: {}'.format(ex))
+        t = self._phase('identify', t)
+        self.settings_cache = {}
+        for address in self.devices:
+            self.serials[address] = self._read_serial(address)
+            self.get_setting(address, 37)
+        self._phase('settings', t)
+
+    def _load_snapshot(self, t):
+        # Use the snapshot when the same devices, with the same serial numbers,
+        # are on the port
+        try:
+            with open(str(self.snapshot_file)) as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != SNAPSHOT_VERSION or not snapshot['devices']:
+                return False
+            devices = snapshot['devices']
+        except (OSError, ValueError, KeyError):
+            return False
+        t = self._phase('snapshot', t)
+
+        expected = {e['address']: e['serial'] for e in devices}
+        if None in expected.values() or self._chain_serials(expected) != expected:
+            self._phase('verify', t)
+            return False
+        t = self._phase('verify', t)
+
+        # devices are not identified, settings are read and written in native units
+        self.devices = {e['address']: self.connection.get_device(e['address']) for e in devices}
+        self.device = self.devices[devices[0]['address']]
+        self.serials = {e['address']: e['serial'] for e in devices}
+        self.settings_cache = {e['address']: {int(k): v for k, v in e['settings'].items()} for e in devices}
+        return True
+
+    def microstep_size(self, device=None):
+        # Microstep size in µm of a device, the first device by default
+        if device is None:
+            return self.zb_microstep_size
+        try:
+            return self.zb_microstep_sizes[device]
+        except KeyError:
+            raise ValueError('Unknown Zaber device: {}'.format(device))
+
+    def dist_mm_to_mustep(self, dist_mm, device=None):
         # Convert mm to microsteps
         dist_microns = dist_mm * 1000.
-        dist_microsteps = dist_microns / self.zb_microstep_size
+        dist_microsteps = dist_microns / self.microstep_size(device)
         rounded_dist_microsteps = int(round(dist_microsteps))
         return rounded_dist_microsteps
 
-    def dist_mustep_to_mm(self, dist_microsteps):
+    def dist_mustep_to_mm(self, dist_microsteps, device=None):
         # Convert microsteps to mm
-        return dist_microsteps * self.zb_microstep_size * 0.001
+        return dist_microsteps * self.microstep_size(device) * 0.001
 
     def dist_data_to_mustep(self, data):
         # Convert data to microsteps
         return data
 
-    def dist_data_to_mm(self, data):
+    def dist_data_to_mm(self, data, device=None):
         # Convert data to mm
-        return self.dist_mustep_to_mm(data)
+        return self.dist_mustep_to_mm(data, device)
 
     def vel_data_to_mustep_per_s(self, data):
         # Convert velocity to microsteps per second
         return data * 9.375
 
-    def vel_data_to_mm_per_s(self, data):
+    def vel_data_to_mm_per_s(self, data, device=None):
         # Convert velocity to microsteps per second
-        return self.dist_mustep_to_mm(data) * 9.375
+        return self.dist_mustep_to_mm(data, device) * 9.375
 
     def vel_mustep_per_s_to_vel(self, vel):
         # Convert microsteps per second to velocity
         return vel / 9.375
 
-    def vel_mm_per_s_to_vel(self, vel):
+    def vel_mm_per_s_to_vel(self, vel, device=None):
         # Convert microsteps per second to velocity
-        return self.dist_mm_to_mustep(vel) / 9.375
+        return self.dist_mm_to_mustep(vel, device) / 9.375
+
+    # #### COMMUNICATION FUNCTIONS
+    # All serial I/O runs on the dispatcher thread, the functions below only
+    # queue work and return futures.
+    def submit(self, device, command, data=0, timeout=0.0, check_errors=True,
+               priority=zaber_dispatcher.PRIORITY_NORMAL):
+        # Queue a command, the future resolves to the device reply
+        future = zaber_command(device, command, data, self.clock)
+        return self.dispatcher.submit(
+            lambda f: self._send(device, command, data, timeout, check_errors), future, priority)
+
+    def submit_no_response(self, device, command, data=0, priority=zaber_dispatcher.PRIORITY_NORMAL):
+        # Queue a command without a reply, the future resolves once it is sent
+        future = zaber_command(device, command, data, self.clock)
+        return self.dispatcher.submit(
+            lambda f: self._send_no_response(device, command, data), future, priority)
+
+    def call(self, fn, *args, priority=zaber_dispatcher.PRIORITY_NORMAL, **kwargs):
+        # Run fn on the dispatcher thread, eg device.settings.get
+        future = zaber_command(0, getattr(fn, '__name__', 'call'), None, self.clock)
+        return self.dispatcher.submit(lambda f: fn(*args, **kwargs), future, priority)
+
+    def command(self, device, command, data=0, timeout=0.0, check_errors=True):
+        # Send a command and wait for its reply
+        if self.dispatcher is None or self.dispatcher.in_dispatcher():
+            return self._send(device, command, data, timeout, check_errors)
+        return self.submit(device, command, data, timeout, check_errors).result()
+
+    def command_no_response(self, device, command, data=0):
+        # Queue a command without waiting for a reply
+        if self.dispatcher is None or self.dispatcher.in_dispatcher():
+            return self._send_no_response(device, command, data)
+        return self.submit_no_response(device, command, data)
+
+    def pipeline(self, commands, priority=zaber_dispatcher.PRIORITY_NORMAL):
+        """Send a batch of commands as one dispatcher job.
+
+        commands is a list of (device, command, data). With message IDs all
+        commands are in flight at once and the replies are matched by ID,
+        otherwise they are sent lock-step. The future resolves to the list of
+        replies in the order of commands.
+        """
+        commands = list(commands)
+        future = zaber_command(commands[0][0] if commands else 0, 'pipeline', commands, self.clock)
+        return self.dispatcher.submit(lambda f: self._send_many(commands), future, priority)
+
+    def move_with_settings(self, device, distance_mustep, speed=None, acceleration=None, absolute=False):
+        """Set speed and acceleration and start a move in one burst.
+
+        Settings that already have the requested value are skipped (see
+        set_setting). With message IDs the settings are in flight together
+        and the move follows their replies, so the burst costs one round-trip
+        whatever the number of settings. Returns a zaber_move handle.
+        """
+        settings = []
+        for code, value in ((CommandCode.SET_TARGET_SPEED.value, speed),
+                            (CommandCode.SET_ACCELERATION.value, acceleration)):
+            if value is None:
+                continue
+            with self._settings_lock:
+                unchanged = self._trusted(code) and self.settings_cache.get(device, {}).get(code) == int(value)
+            if unchanged:
+                self.settings_stats['saved_writes'] += 1
+            else:
+                self.settings_stats['writes'] += 1
+                settings.append((device, code, int(value)))
+
+        command = CommandCode.MOVE_ABSOLUTE if absolute else CommandCode.MOVE_RELATIVE
+        move = self._register(device, command, distance_mustep)
+
+        def send(future):
+            move._transactions_start = self._device_transactions(move.device)
+            replies = self._send_many(settings, (device, command, distance_mustep),
+                                      on_sent=lambda t: setattr(move, 'start_time', t))
+            move.setting_errors = [r for r in replies if isinstance(r, Exception)]
+
+        self._dispatch([move], send)
+        return move
+
+    def move_relative(self, distance_mustep, device=1):
+        # Start a relative move, returns a zaber_move handle
+        return self._move(device, CommandCode.MOVE_RELATIVE, distance_mustep)
+
+    def move_absolute(self, position_mustep, device=1):
+        # Start an absolute move, returns a zaber_move handle
+        return self._move(device, CommandCode.MOVE_ABSOLUTE, position_mustep)
+
+    def move_many(self, moves):
+        """Start moves on several axes in one pipelined burst.
+
+        moves is a list of (device, command, data); the packets are written
+        back to back by a single dispatcher job without waiting for replies,
+        so the onsets differ by one packet time. Returns a zaber_move_group.
+        """
+        if not moves:
+            raise ValueError('No moves given')
+        handles = [self._register(device, command, data) for device, command, data in moves]
+
+        def send(future):
+            for move in handles:
+                move.start_time = self.clock()
+                move._transactions_start = self._device_transactions(move.device)
+                self._send_no_response(move.device, move.command, move.data)
+
+        self._dispatch(handles, send)
+        return zaber_move_group(handles, self.clock)
+
+    def move_relative_many(self, distances):
+        # distances: {device: distance in microsteps}
+        return self.move_many([(d, CommandCode.MOVE_RELATIVE, v) for d, v in distances.items()])
+
+    def move_broadcast(self, command, data):
+        # Start the same move on all axes with a single packet to device 0
+        handles = [self._register(device, command, data) for device in self.devices]
+
+        def send(future):
+            for move in handles:
+                move.start_time = future.send_time
+                move._transactions_start = self._device_transactions(move.device)
+            self._send_no_response(0, command, data)
+
+        self._dispatch(handles, send, device=0)
+        return zaber_move_group(handles, self.clock)
+
+    def stop(self, device=1):
+        # Stop the device ahead of any queued command, the pending move handle
+        # completes with the stop reply; device 0 stops all axes
+        with self._moves_lock:
+            if device == 0:
+                move = [self._moves[d] for d in self.devices if d in self._moves]
+                move = zaber_move_group(move, self.clock) if move else None
+            else:
+                move = self._moves.get(device)
+        self.submit_no_response(device, CommandCode.STOP, priority=zaber_dispatcher.PRIORITY_URGENT)
+        return move
+
+    def position(self, device=1, max_age=None, refresh=False):
+        """Position of a device in microsteps from the local position model.
+
+        The model follows every reply that carries a position (move
+        completion, position queries, manual moves). The device is only
+        queried when the position is unknown, older than max_age seconds,
+        while the device moves, or when refresh is True. On a daemon
+        connection the moves of other clients are not seen, the device is
+        then always queried and max_age is ignored.
+        """
+        with self._position_lock:
+            known = self.positions.get(device)
+        with self._moves_lock:
+            moving = device in self._moves
+        if (refresh or self.shared or known is None or moving
+                or (max_age is not None and self.clock() - known[1] > max_age)):
+            self.position_stats['queries'] += 1
+            return self.command(device, CommandCode.RETURN_CURRENT_POSITION).data
+        self.position_stats['saved'] += 1
+        return known[0]
+
+    def invalidate_position(self, device=None):
+        # Forget the modelled position, the next position() call queries the device
+        with self._position_lock:
+            if device is None:
+                self.positions = {}
+            else:
+                self.positions.pop(device, None)
+
+    def wait_move(self, move, timeout=None, poll=None, interval=0.005):
+        """Wait for a move to finish without querying the device.
+
+        poll is called every interval seconds while waiting; when it returns
+        False the wait is abandoned. Returns True when the move finished.
+        """
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        while not move.wait(interval):
+            if poll is not None and poll() is False:
+                return False
+            if t_end is not None and time.perf_counter() > t_end:
+                raise TimeoutError('Zaber move on device {} did not finish within {} s'.format(move.device, timeout))
+        if move.error is not None:
+            raise move.error
+        return True
+
+    def error_text(self, code):
+        return self.errorDict.get(code, ['Unknown error', ''])[0]
+
+    def _send(self, device, command, data, timeout, check_errors):
+        self._count(device)
+        self._check_reset(device, command)
+        reply = self.connection.generic_command(device, command_code(command), data, timeout=timeout,
+                                                check_errors=check_errors)
+        self._track(reply)
+        return reply
+
+    def _send_no_response(self, device, command, data):
+        self._count(device)
+        self._check_reset(device, command)
+        self.connection.generic_command_no_response(device, command_code(command), data)
+
+    def _send_many(self, commands, move=None, on_sent=None):
+        # Replies to commands, move is sent last without waiting for its reply;
+        # on_sent(t) is called with the time the move was handed to the port
+        if self.message_ids and hasattr(self.connection, 'generic_command_async'):
+            return asyncio.run(self._send_async(commands, move, on_sent))
+        replies = [self._send(d, c, v, 0.0, True) for d, c, v in commands]
+        if move is not None:
+            if on_sent is not None:
+                on_sent(self.clock())
+            self._send_no_response(*move)
+        return replies
+
+    async def _send_async(self, commands, move, on_sent):
+        tasks = []
+        for device, command, data in commands:
+            self._count(device)
+            self._check_reset(device, command)
+            tasks.append(asyncio.ensure_future(
+                self.connection.generic_command_async(device, command_code(command), data)))
+        replies = await asyncio.gather(*tasks, return_exceptions=True)
+        if move is not None:
+            # ZML treats the replies still pending on a device as pre-empted by
+            # a move, so the move follows the replies of the batch
+            device, command, data = move
+            self._count(device)
+            if on_sent is not None:
+                on_sent(self.clock())
+            await self.connection.generic_command_no_response_async(device, command_code(command), data)
+        errors = []
+        for (device, command, data), reply in zip(commands, list(replies)):
+            if isinstance(reply, Exception):
+                self.invalidate_settings(device, setting_code(command))
+                errors.append(reply)
+            else:
+                self._track(reply)
+        if errors and move is None:
+            raise errors[0]
+        # the move is on its way, report the failed settings with the replies
+        return replies
+
+    def _count(self, device):
+        # Every transaction counts in transactions, those of foreground jobs also
+        # per addressed device (device 0 addresses all), so background position
+        # polls are not charged to the moves
+        self.transactions += 1
+        if self.dispatcher is not None and self.dispatcher.in_background():
+            return
+        for address in (self.devices if device == 0 else (device,)):
+            self.device_transactions[address] = self.device_transactions.get(address, 0) + 1
+
+    def _device_transactions(self, device):
+        return self.device_transactions.get(device, 0)
+
+    def _track(self, reply):
+        # Update the position model and the settings cache from a reply
+        if reply.command in POSITION_CODES:
+            self._set_position(reply.device_address, reply.data)
+        self._cache_setting(reply.device_address, reply.command, reply.data)
+
+    def _check_reset(self, device, command):
+        if setting_code(command) in RESET_CODES:
+            self.invalidate_settings(None if device == 0 else device)
+            self.invalidate_position(None if device == 0 else device)
+
+    def _set_position(self, device, position):
+        with self._position_lock:
+            self.positions[device] = (position, self.clock())
+
+    def _move(self, device, command, data):
+        move = self._register(device, command, data)
+
+        def send(future):
+            move.start_time = future.send_time
+            move._transactions_start = self._device_transactions(move.device)
+            self._send_no_response(device, command, data)
+
+        self._dispatch([move], send)
+        return move
+
+    def _register(self, device, command, data):
+        if device not in self.devices:
+            raise ValueError('Unknown Zaber device: {}'.format(device))
+        move = zaber_move(device, command, data, self.clock, self._device_transactions(device))
+        # register before sending, the reply can arrive before we return
+        with self._moves_lock:
+            previous = self._moves.get(device)
+            self._moves[device] = move
+        if previous is not None:
+            previous._finish(interrupted=True, transactions=self._device_transactions(device))
+        return move
+
+    def _dispatch(self, moves, send, device=None):
+        # Queue the job that sends the moves, fail the handles if it cannot be sent
+        def sent(future):
+            if future.error is not None:
+                for move in moves:
+                    self._release(move.device, move)
+                    move._finish(error=future.error, transactions=self._device_transactions(move.device))
+
+        first = moves[0]
+        request = zaber_command(first.device if device is None else device, first.command, first.data, self.clock)
+        for move in moves:
+            move.request = request
+        request.add_done_callback(sent)
+        try:
+            self.dispatcher.submit(send, request)
+        except Exception as ex:
+            for move in moves:
+                self._release(move.device, move)
+                move._finish(error=ex, transactions=self._device_transactions(move.device))
+            raise
+
+    def _release(self, device, move):
+        with self._moves_lock:
+            if self._moves.get(device) is move:
+                del self._moves[device]
+
+    def _on_reply(self, event):
+        # Called from the library event thread for unsolicited replies
+        device = event.device_address
+        if event.command == ReplyCode.ERROR.value:
+            # the error code of a rejected setting is its command number,
+            # after a failed move the position is unknown
+            self.invalidate_settings(device, event.data)
+            self.invalidate_position(device)
+        else:
+            self._cache_setting(device, event.command, event.data)
+            if event.command in POSITION_CODES:
+                self._set_position(device, event.data)
+
+        with self._moves_lock:
+            move = self._moves.get(device)
+        if move is None:
+            return
+
+        if event.command == ReplyCode.ERROR.value:
+            self._release(device, move)
+            error = RuntimeError('Zaber error {}: {}'.format(event.data, self.error_text(event.data)))
+            move._finish(error=error, transactions=self._device_transactions(device))
+        elif event.command in MOVE_COMPLETE_CODES:
+            self._release(device, move)
+            move._finish(position=event.data,
+                         interrupted=event.command == CommandCode.STOP.value,
+                         transactions=self._device_transactions(device))
+
+    def close(self):
+        for subscription in getattr(self, '_subscriptions', []):
+            subscription.dispose()
+        if self._snapshot_dirty and self._connected:
+            self.save_snapshot()
+        with self._moves_lock:
+            moves, self._moves = list(self._moves.values()), {}
+        for move in moves:
+            move._finish(interrupted=True, transactions=self._device_transactions(move.device))
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        if self.message_ids:
+            # leave the devices in the default mode for the other tools
+            self.connection.generic_command_no_response(0, CommandCode.SET_MESSAGE_ID_MODE, 0)
+        self.connection.close()
+
+
+# #### TELEMETRY
+# seq is the sample number, -1 marks an unused slot of the ring buffer
+TELEMETRY_DTYPE = np.dtype([('seq', 'i8'), ('t', 'f8'), ('position', 'i8')])
+
+
+class position_recorder:
+    """Background sampler of the device position.
+
+    Samples are written into a preallocated ring buffer that is memory-mapped
+    to a .npy file, so read_telemetry() can read it while the session runs.
+    Timestamps are the midpoint of the request and the reply on the clock of
+    the zaber_tools object. Position requests are queued at background
+    priority and a tick is skipped while other commands are waiting.
+    A request in progress still holds the port for a round trip, so a
+    command queued during it waits: at 20 Hz and 9600 baud the command
+    latency goes from a p50 of about 16 ms to 18.5 ms, with a maximum of
+    about 31 ms. hold() keeps the requests off the port around a known
+    command time, eg the onset of a move.
+    """
+
+    def __init__(self, zt, path, rate=20.0, capacity=131072, device=1, flush_interval=1.0):
+        self.zt = zt
+        self.path = str(path)
+        self.rate = rate
+        self.device = device
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.samples = 0
+        self.skipped = 0
+        self.held = 0  # ticks skipped by hold()
+        self.errors = 0
+        self.round_trip = 0.0  # longest round trip of a request, s
+        self._holds = []  # (start, end) on the clock of zt
+        self._holds_lock = threading.Lock()
+        self.buffer = np.lib.format.open_memmap(self.path, mode='w+', dtype=TELEMETRY_DTYPE, shape=(capacity,))
+        self.buffer['seq'] = -1
+        self.buffer.flush()
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name='zaber-telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.buffer.flush()
+
+    def hold(self, t_start, t_end):
+        # No request that could still hold the port at t_start is sent before
+        # t_end (clock of zt), eg around the onset of a move
+        with self._holds_lock:
+            self._holds.append((t_start, t_end))
+
+    def _held(self, now):
+        # Whether a request sent now could overlap a hold
+        with self._holds_lock:
+            self._holds = [h for h in self._holds if h[1] > now]
+            return any(now + self.round_trip >= start for start, end in self._holds)
+
+    def latest(self, n=None):
+        # Most recent samples in chronological order (a copy)
+        count = min(self.samples, self.capacity)
+        if n is not None:
+            count = min(count, n)
+        idx = np.arange(self.samples - count, self.samples) % self.capacity
+        return self.buffer[idx]
+
+    def velocity(self, window=0.5):
+        """Least-squares slope of the position over the last window seconds.
+
+        Returns microsteps/s, or None with fewer than 2 samples in the window.
+        """
+        samples = self.latest(int(window * self.rate) + 1)
+        if len(samples) < 2:
+            return None
+        samples = samples[samples['t'] >= samples['t'][-1] - window]
+        t = samples['t'] - samples['t'].mean()
+        x = samples['position'] - samples['position'].mean()
+        den = np.dot(t, t)
+        if len(samples) < 2 or den <= 0:
+            return None
+        return float(np.dot(t, x) / den)
+
+    def age(self, now):
+        # Time since the last sample, None before the first one
+        if self.samples == 0:
+            return None
+        return now - self.buffer[(self.samples - 1) % self.capacity]['t']
+
+    def _run(self):
+        period = 1. / self.rate
+        t_next = time.perf_counter()
+        t_flush = t_next + self.flush_interval
+        while self._running.is_set():
+            if self._held(self.zt.clock()):
+                self.held += 1
+            elif self.zt.dispatcher.pending() == 0:
+                self._sample(period)
+            else:
+                self.skipped += 1
+
+            now = time.perf_counter()
+            if now >= t_flush:
+                self.buffer.flush()
+                t_flush = now + self.flush_interval
+
+            t_next += period
+            if t_next < now:
+                t_next = now  # fell behind, do not burst to catch up
+            time.sleep(max(0., t_next - time.perf_counter()))
+
+    def _sample(self, timeout):
+        future = self.zt.submit(self.device, CommandCode.RETURN_CURRENT_POSITION,
+                                priority=zaber_dispatcher.PRIORITY_BACKGROUND)
+        if not future.wait(max(timeout, 0.5)) or future.error is not None:
+            self.errors += 1
+            return
+        self.round_trip = max(self.round_trip, future.reply_time - future.send_time)
+        # seqlock: the slot is marked as being written, the seq is written last
+        slot = self.buffer[self.samples % self.capacity]
+        slot['seq'] = -1
+        slot['t'] = (future.send_time + future.reply_time) / 2
+        slot['position'] = future.reply.data
+        slot['seq'] = self.samples
+        self.samples += 1
+
+
+def read_telemetry(path):
+    # Samples of a (running) position_recorder file in chronological order;
+    # a slot is kept when its seq is valid and the same before and after the
+    # copy, so a slot the recorder was rewriting is skipped
+    buffer = np.load(str(path), mmap_mode='r')
+    seq = np.array(buffer['seq'])
+    samples = np.array(buffer)
+    samples = samples[(seq >= 0) & (np.array(buffer['seq']) == seq)]
+    return samples[np.argsort(samples['seq'])]